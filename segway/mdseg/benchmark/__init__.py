@@ -0,0 +1,4 @@
+from .synthetic_lut import SyntheticLUT
+from .grow_benchmark import run_benchmarks, format_results
+
+__all__ = ['SyntheticLUT', 'run_benchmarks', 'format_results']
@@ -0,0 +1,54 @@
+'''Generates a synthetic LUT and times grows on it, e.g.
+
+    python -m segway.mdseg.benchmark --grid 4 4 4 --lut-format npy
+'''
+import argparse
+import json
+import tempfile
+
+from ..lut_io import convert_super_lut
+from . import SyntheticLUT, run_benchmarks, format_results
+
+parser = argparse.ArgumentParser(prog='python -m segway.mdseg.benchmark')
+parser.add_argument('--out-dir', default=None,
+                    help="Where to write the LUT, defaults to a temporary directory")
+parser.add_argument('--grid', type=int, nargs=3, default=[2, 2, 2],
+                    help="Volume size in super blocks (z y x)")
+parser.add_argument('--fragments-per-block', type=int, default=8)
+parser.add_argument('--edges-per-fragment', type=float, default=2.0)
+parser.add_argument('--thresholds', type=float, nargs='+', default=[0.4, 0.5, 0.6])
+parser.add_argument('--base-threshold', type=float, default=0.5)
+parser.add_argument('--lut-format', default='npz', choices=['npz', 'npy', 'sharded'])
+parser.add_argument('--grows', type=int, default=20)
+parser.add_argument('--selection-size', type=int, default=10)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--json', action='store_true', help="Print results as JSON")
+args = parser.parse_args()
+
+lut = SyntheticLUT(
+    grid_shape=args.grid,
+    fragments_per_block=args.fragments_per_block,
+    edges_per_fragment=args.edges_per_fragment,
+    thresholds=args.thresholds,
+    base_threshold=args.base_threshold,
+    seed=args.seed,
+    )
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    out_dir = args.out_dir or tmp_dir
+    lut.write(out_dir)
+    if args.lut_format != 'npz':
+        for threshold in lut.thresholds:
+            convert_super_lut(lut.lut_dir(out_dir, threshold), args.lut_format)
+
+    results = run_benchmarks(
+        lut, out_dir,
+        num_grows=args.grows,
+        selection_size=args.selection_size,
+        server_kwargs={'lut_format': args.lut_format},
+        seed=args.seed)
+
+if args.json:
+    print(json.dumps(results, indent=2))
+else:
+    print(format_results(results))
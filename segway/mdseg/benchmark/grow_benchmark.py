@@ -0,0 +1,111 @@
+'''Times `find_connected_super_fragments` of both segment servers on a
+`SyntheticLUT`.
+
+Cases:
+
+    cold: every grow starts with empty LUT caches
+    warm: the same grows repeated with the caches filled
+    z_only: warm grows restricted to the selection's z column
+    threshold_XX: warm grows at each threshold of the LUT
+
+connected_segment_server2 only supports grows at the base threshold, so its
+threshold cases are limited to that.
+'''
+import time
+
+import numpy as np
+
+from ..connected_segment_server import ConnectedSegmentServer
+from ..connected_segment_server2 import ConnectedSegmentServer as ConnectedSegmentServer2
+
+
+def random_selections(lut, num_grows, selection_size, seed=0):
+    '''Returns `num_grows` lists of fragments to grow from'''
+    rng = np.random.default_rng(seed)
+    return [rng.choice(lut.fragments, selection_size, replace=False).tolist()
+            for _ in range(num_grows)]
+
+
+def time_grows(server, selections, threshold, z_only=False, before_grow=None):
+    '''Returns the duration in seconds and the result size of each grow'''
+    timings = []
+    sizes = []
+    for selection in selections:
+        if before_grow is not None:
+            before_grow()
+        start = time.perf_counter()
+        connected = server.find_connected_super_fragments(
+            selection, [], threshold, z_only=z_only)
+        timings.append(time.perf_counter() - start)
+        sizes.append(len(connected))
+    return np.array(timings), np.array(sizes)
+
+
+def _summarize(server_name, case, timings, sizes):
+    return {
+        'server': server_name,
+        'case': case,
+        'grows': len(timings),
+        'median_ms': float(np.median(timings)) * 1000,
+        'p90_ms': float(np.percentile(timings, 90)) * 1000,
+        'max_ms': float(np.max(timings)) * 1000,
+        'mean_size': float(np.mean(sizes)),
+    }
+
+
+def _run_cases(server_name, server, clear_cache, selections, thresholds, base_threshold):
+    results = []
+
+    timings, sizes = time_grows(
+        server, selections, base_threshold, before_grow=clear_cache)
+    results.append(_summarize(server_name, 'cold', timings, sizes))
+
+    # fill the caches once before the warm cases
+    time_grows(server, selections, base_threshold)
+    timings, sizes = time_grows(server, selections, base_threshold)
+    results.append(_summarize(server_name, 'warm', timings, sizes))
+
+    timings, sizes = time_grows(server, selections, base_threshold, z_only=True)
+    results.append(_summarize(server_name, 'z_only', timings, sizes))
+
+    for threshold in thresholds:
+        time_grows(server, selections, threshold)
+        timings, sizes = time_grows(server, selections, threshold)
+        results.append(_summarize(
+            server_name, 'threshold_%d' % int(threshold*100), timings, sizes))
+
+    return results
+
+
+def run_benchmarks(lut, hierarchy_lut_path, num_grows=20, selection_size=10,
+                   server_kwargs=None, seed=0):
+    '''Runs all cases on the LUT written by ``lut.write(hierarchy_lut_path)``
+    and returns one result dict per (server, case). `server_kwargs` are
+    passed on to connected_segment_server, e.g. ``{'lut_format': 'npy'}``.'''
+    selections = random_selections(lut, num_grows, selection_size, seed=seed)
+    kwargs = lut.server_kwargs(hierarchy_lut_path)
+
+    server = ConnectedSegmentServer(**kwargs, **(server_kwargs or {}))
+    try:
+        results = _run_cases(
+            'connected_segment_server', server, server.lut_cache.clear,
+            selections, lut.thresholds, lut.base_threshold)
+    finally:
+        server.close()
+
+    server2 = ConnectedSegmentServer2(blockstore=lut.blockstore(), **kwargs)
+    results += _run_cases(
+        'connected_segment_server2', server2, server2.lut_cache.clear,
+        selections, [lut.base_threshold], lut.base_threshold)
+
+    return results
+
+
+def format_results(results):
+    lines = ['%-26s %-14s %6s %10s %10s %10s %10s' % (
+        'server', 'case', 'grows', 'median_ms', 'p90_ms', 'max_ms', 'mean_size')]
+    for r in results:
+        lines.append('%-26s %-14s %6d %10.3f %10.3f %10.3f %10.1f' % (
+            r['server'], r['case'], r['grows'], r['median_ms'], r['p90_ms'],
+            r['max_ms'], r['mean_size']))
+    return '\n'.join(lines)
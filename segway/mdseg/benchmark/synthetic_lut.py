@@ -0,0 +1,199 @@
+'''Generates synthetic hierarchy LUTs in the layout read by the connected
+segment servers, so that grows can be timed without a real segmentation.
+
+Fragments are placed on a regular grid of fragment blocks and connected to
+fragments of the same and the face-adjacent fragment blocks. Every edge gets
+a random merge score and exists at all thresholds >= its score, so higher
+thresholds give larger segments, as with a real agglomeration.
+
+Written layout (`t` is a threshold times 100):
+
+    <out_dir>/<super_lut_pre>_<t>/edges_super2super/<super_block_id>.npz
+    <out_dir>/<super_lut_pre>_<base>/threshold_map_<t>/<super_block_id>.npz
+
+An edge is stored in the super blocks of both of its fragments. The
+``threshold_map`` of a super block lists the segments at `t` restricted to
+the fragments of that block (single fragments are omitted).
+'''
+import itertools
+import os
+
+import numpy as np
+
+from funlib.geometry import Coordinate
+
+from ..cantor import cantor_numbers
+from ..lut_index import connected_component_labels
+
+
+class SyntheticLUT():
+    '''Synthetic fragment graph plus the server arguments to read it.
+
+    `grid_shape` is the volume size in super blocks, `fragments_per_block`
+    the number of fragments per fragment block and `edges_per_fragment` the
+    average number of edges a fragment starts. `z_fraction` is the share of
+    edges that go to the next fragment block in z, which is what ``z_only``
+    grows follow.
+    '''
+
+    def __init__(
+            self,
+            grid_shape=(2, 2, 2),
+            fragments_per_block=8,
+            edges_per_fragment=2.0,
+            z_fraction=0.5,
+            thresholds=(0.4, 0.5, 0.6),
+            base_threshold=0.5,
+            find_segment_block_size=(4, 16, 16),
+            super_block_size=(8, 32, 32),
+            fragments_block_size=(2, 8, 8),
+            voxel_size=(1, 1, 1),
+            super_lut_pre='super_synthetic',
+            seed=0,
+            ):
+
+        assert base_threshold in thresholds
+        self.grid_shape = Coordinate(grid_shape)
+        self.thresholds = sorted(thresholds)
+        self.base_threshold = base_threshold
+        self.find_segment_block_size = Coordinate(find_segment_block_size)
+        self.super_block_size = Coordinate(super_block_size)
+        self.fragments_block_size = Coordinate(fragments_block_size)
+        self.voxel_size = Coordinate(voxel_size)
+        self.super_lut_pre = super_lut_pre
+
+        num_voxels = np.prod(self.fragments_block_size / self.voxel_size)
+        assert fragments_per_block < num_voxels
+        self.num_voxels_in_fragment_block = int(num_voxels)
+
+        rng = np.random.default_rng(seed)
+
+        # fragment block grid, and the super block each fragment block is in
+        self.frag_blocks_per_super = self.super_block_size / self.fragments_block_size
+        frag_grid = self.grid_shape * self.frag_blocks_per_super
+        frag_block_index = np.array(
+            list(itertools.product(*[range(n) for n in frag_grid])),
+            dtype=np.int64)
+        num_frag_blocks = len(frag_block_index)
+        self.frag_block_index = frag_block_index
+
+        # fragment `k` of a block has id cantor(block index) * num_voxels + k
+        block_ids = cantor_numbers(frag_block_index).astype(np.uint64)
+        self.fragment_block = np.repeat(
+            np.arange(num_frag_blocks), fragments_per_block)
+        self.fragments = (
+            block_ids[self.fragment_block] * np.uint64(num_voxels)
+            + np.tile(np.arange(1, fragments_per_block + 1, dtype=np.uint64),
+                      num_frag_blocks))
+        self.fragment_block_index = frag_block_index[self.fragment_block]
+        self.fragment_super_index = (
+            self.fragment_block_index // np.asarray(self.frag_blocks_per_super))
+        self.fragment_super_id = cantor_numbers(self.fragment_super_index)
+
+        # edges to a random fragment of the same, the next z, the next y or
+        # the next x fragment block
+        num_fragments = len(self.fragments)
+        num_edges = int(num_fragments * edges_per_fragment)
+        u = rng.integers(num_fragments, size=num_edges)
+        side_fraction = (1 - z_fraction) / 3
+        direction = rng.choice(
+            4, size=num_edges,
+            p=[side_fraction, z_fraction, side_fraction, side_fraction])
+        step = np.zeros((num_edges, 3), dtype=np.int64)
+        step[direction > 0, direction[direction > 0] - 1] = 1
+        v_block_index = self.fragment_block_index[u] + step
+        inside = (v_block_index < np.asarray(frag_grid)).all(axis=1)
+        u = u[inside]
+        v_block_index = v_block_index[inside]
+        v_block = np.ravel_multi_index(v_block_index.T, tuple(frag_grid))
+        v = (v_block * fragments_per_block
+             + rng.integers(fragments_per_block, size=len(v_block)))
+        keep = u != v
+        self.edges = np.stack([u[keep], v[keep]], axis=1)
+        self.scores = rng.random(len(self.edges))
+
+    @property
+    def num_fragments(self):
+        return len(self.fragments)
+
+    def super_block_ids(self):
+        return np.unique(self.fragment_super_id)
+
+    def edges_at(self, threshold):
+        '''Returns the fragment index pairs of all edges at `threshold`'''
+        return self.edges[self.scores <= threshold]
+
+    def server_kwargs(self, hierarchy_lut_path):
+        '''Keyword arguments to construct a ConnectedSegmentServer on the
+        LUT written by `write` to `hierarchy_lut_path`'''
+        return dict(
+            hierarchy_lut_path=hierarchy_lut_path,
+            super_lut_pre=self.super_lut_pre,
+            find_segment_block_size=tuple(self.find_segment_block_size),
+            super_block_size=tuple(self.super_block_size),
+            fragments_block_size=tuple(self.fragments_block_size),
+            voxel_size=tuple(self.voxel_size),
+            base_threshold=self.base_threshold,
+            )
+
+    def lut_dir(self, out_dir, threshold):
+        return os.path.join(
+            out_dir, self.super_lut_pre + '_%d' % int(threshold*100))
+
+    def write(self, out_dir):
+        '''Writes the edges and threshold maps of all thresholds'''
+        base_dir = self.lut_dir(out_dir, self.base_threshold)
+        for threshold in self.thresholds:
+            self.write_edges(
+                os.path.join(self.lut_dir(out_dir, threshold), 'edges_super2super'),
+                threshold)
+            self.write_threshold_map(
+                os.path.join(base_dir, 'threshold_map_%d' % int(threshold*100)),
+                threshold)
+
+    def write_edges(self, lut_dir, threshold):
+        os.makedirs(lut_dir, exist_ok=True)
+        edges = self.edges_at(threshold)
+        super_u = self.fragment_super_id[edges[:, 0]]
+        super_v = self.fragment_super_id[edges[:, 1]]
+        for super_block_id in self.super_block_ids().tolist():
+            in_block = (super_u == super_block_id) | (super_v == super_block_id)
+            np.savez_compressed(
+                os.path.join(lut_dir, '%d.npz' % super_block_id),
+                edges=self.fragments[edges[in_block]])
+
+    def write_threshold_map(self, lut_dir, threshold):
+        os.makedirs(lut_dir, exist_ok=True)
+        labels = connected_component_labels(
+            self.num_fragments, self.edges_at(threshold))
+        for super_block_id in self.super_block_ids().tolist():
+            members = np.flatnonzero(self.fragment_super_id == super_block_id)
+            member_labels = labels[members]
+            order = np.argsort(member_labels, kind='stable')
+            _, starts, counts = np.unique(
+                member_labels[order], return_index=True, return_counts=True)
+            components = [
+                self.fragments[members[order[start:start+count]]]
+                for start, count in zip(starts, counts) if count > 1]
+            threshold_map = np.empty(len(components), dtype=object)
+            for i, component in enumerate(components):
+                threshold_map[i] = component
+            np.savez_compressed(
+                os.path.join(lut_dir, '%d.npz' % super_block_id),
+                threshold_map=threshold_map)
+
+    def blockstore(self):
+        '''Returns the in-memory blockstore of connected_segment_server2,
+        {threshold: {fragment block roi begin: edges}}'''
+        roi_begins = [
+            Coordinate(index) * self.fragments_block_size
+            for index in self.frag_block_index]
+        blockstore = {}
+        for threshold in self.thresholds:
+            edges = self.edges_at(threshold)
+            block_u = self.fragment_block[edges[:, 0]]
+            block_v = self.fragment_block[edges[:, 1]]
+            blockstore[threshold] = {
+                roi_begin: self.fragments[edges[(block_u == b) | (block_v == b)]]
+                for b, roi_begin in enumerate(roi_begins)}
+        return blockstore
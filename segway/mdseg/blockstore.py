@@ -0,0 +1,257 @@
+'''Blockstores of per-fragment-block edge lists for connected_segment_server2.
+
+The server reads edges as ``blockstore[threshold][roi_begin]``, where
+`roi_begin` is the begin of a fragment block ROI in world units, and a
+blockstore can be any object supporting that (e.g. nested dicts). The
+classes here implement it on top of a storage backend:
+
+    NpyDirectoryBlockstore: one ``<t>/<z>_<y>_<x>.npy`` file per block,
+        memory-mapped on read
+    SQLiteBlockstore: a single SQLite file with one row per block
+    PackedBlockstore: per threshold one ``<t>.bin`` file of serialized
+        blocks plus a ``<t>.index.npy`` offset table, memory-mapped
+
+(`t` is the threshold times 100.) All of them cache decoded blocks in a
+byte-budgeted LRU, read the blocks missing from the cache in one batch in
+`get_many`, and raise KeyError for blocks that do not exist.
+'''
+import io
+import os
+import sqlite3
+from threading import Lock
+
+import numpy as np
+
+from .lut_cache import LUTCache
+from .lut_io import _array_from_npy_buffer, _save_npy
+
+PACKED_INDEX_DTYPE = np.dtype([
+    ('z', np.int64),
+    ('y', np.int64),
+    ('x', np.int64),
+    ('offset', np.int64),
+    ('length', np.int64),
+])
+
+
+def _threshold_key(threshold):
+    return int(threshold*100)
+
+
+def _block_key(roi_begin):
+    return tuple(int(c) for c in roi_begin)
+
+
+class _ThresholdView():
+    '''``blockstore[threshold]``, indexed by fragment block roi begin'''
+
+    def __init__(self, blockstore, threshold):
+        self.blockstore = blockstore
+        self.threshold = threshold
+
+    def __getitem__(self, roi_begin):
+        return self.blockstore.get(self.threshold, roi_begin)
+
+    def get_many(self, roi_begins):
+        return self.blockstore.get_many(self.threshold, roi_begins)
+
+
+class Blockstore():
+    '''Base class of the cached blockstores.
+
+    Derived classes implement `_read_many`, returning {block key: edges}
+    for the given ``(z, y, x)`` block keys that exist, and `_write`.
+    '''
+
+    def __init__(self, cache_bytes=1024*1024*1024):
+        self.lut_cache = LUTCache(cache_bytes)
+        self.lock = Lock()
+        self.reads = 0
+
+    def __getitem__(self, threshold):
+        return _ThresholdView(self, threshold)
+
+    def _read_many(self, t, block_keys):
+        raise RuntimeError("To be implemented by derived class")
+
+    def _write(self, t, blocks):
+        raise RuntimeError("To be implemented by derived class")
+
+    def write(self, threshold, blocks):
+        '''Stores {roi_begin: edges} at `threshold`'''
+        self._write(_threshold_key(threshold), blocks)
+        self.lut_cache.clear()
+
+    def close(self):
+        pass
+
+    def get(self, threshold, roi_begin):
+        return self.get_many(threshold, [roi_begin])[0]
+
+    def get_many(self, threshold, roi_begins):
+        '''Returns the edges of each block in `roi_begins`, reading all
+        blocks missing from the cache in one batch'''
+        t = _threshold_key(threshold)
+        block_keys = [_block_key(roi_begin) for roi_begin in roi_begins]
+        blocks = {}
+        missing = []
+        for block_key in block_keys:
+            if block_key in blocks:
+                continue
+            edges = self.lut_cache.get((t, block_key))
+            if edges is None:
+                missing.append(block_key)
+            else:
+                blocks[block_key] = edges
+
+        if missing:
+            read = self._read_many(t, missing)
+            with self.lock:
+                self.reads += len(read)
+            for block_key, edges in read.items():
+                self.lut_cache.put((t, block_key), edges)
+                blocks[block_key] = edges
+
+        try:
+            return [blocks[block_key] for block_key in block_keys]
+        except KeyError as e:
+            raise KeyError(f'No block at {e.args[0]} for threshold {threshold}')
+
+    def stats(self):
+        '''Returns the cache statistics plus the number of blocks read from
+        the backend'''
+        stats = self.lut_cache.stats()
+        stats['reads'] = self.reads
+        return stats
+
+
+class NpyDirectoryBlockstore(Blockstore):
+
+    def __init__(self, root, cache_bytes=1024*1024*1024, mmap_mode='r'):
+        super().__init__(cache_bytes)
+        self.root = root
+        self.mmap_mode = mmap_mode
+
+    def path(self, t, block_key):
+        return os.path.join(self.root, str(t), '%d_%d_%d.npy' % block_key)
+
+    def _read_many(self, t, block_keys):
+        blocks = {}
+        for block_key in block_keys:
+            path = self.path(t, block_key)
+            if os.path.exists(path):
+                blocks[block_key] = np.load(path, mmap_mode=self.mmap_mode)
+        return blocks
+
+    def _write(self, t, blocks):
+        os.makedirs(os.path.join(self.root, str(t)), exist_ok=True)
+        for roi_begin, edges in blocks.items():
+            _save_npy(self.path(t, _block_key(roi_begin)),
+                      np.asarray(edges, dtype=np.uint64))
+
+
+class SQLiteBlockstore(Blockstore):
+
+    # SQLite allows at most 999 parameters per statement by default
+    max_keys_per_query = 300
+
+    def __init__(self, db_file, cache_bytes=1024*1024*1024):
+        super().__init__(cache_bytes)
+        self.db_file = db_file
+        self.db_lock = Lock()
+        self.con = sqlite3.connect(db_file, check_same_thread=False)
+        self.con.execute(
+            'CREATE TABLE IF NOT EXISTS blocks ('
+            'threshold INTEGER, z INTEGER, y INTEGER, x INTEGER, edges BLOB, '
+            'PRIMARY KEY (threshold, z, y, x))')
+
+    def close(self):
+        with self.db_lock:
+            self.con.close()
+
+    def _read_many(self, t, block_keys):
+        blocks = {}
+        for i in range(0, len(block_keys), self.max_keys_per_query):
+            chunk = block_keys[i:i+self.max_keys_per_query]
+            values = ', '.join(['(?, ?, ?)'] * len(chunk))
+            query = ('SELECT z, y, x, edges FROM blocks WHERE threshold=? '
+                     f'AND (z, y, x) IN (VALUES {values})')
+            params = [t] + [c for block_key in chunk for c in block_key]
+            with self.db_lock:
+                rows = self.con.execute(query, params).fetchall()
+            for z, y, x, data in rows:
+                blocks[(z, y, x)] = np.load(io.BytesIO(data))
+        return blocks
+
+    def _write(self, t, blocks):
+        rows = []
+        for roi_begin, edges in blocks.items():
+            buf = io.BytesIO()
+            np.save(buf, np.asarray(edges, dtype=np.uint64))
+            rows.append((t,) + _block_key(roi_begin) + (buf.getvalue(),))
+        with self.db_lock:
+            with self.con:
+                self.con.executemany(
+                    'INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)', rows)
+
+
+class PackedBlockstore(Blockstore):
+
+    def __init__(self, root, cache_bytes=1024*1024*1024):
+        super().__init__(cache_bytes)
+        self.root = root
+        self.packs = {}
+
+    def _get_pack(self, t):
+        with self.lock:
+            if t not in self.packs:
+                index_path = os.path.join(self.root, '%d.index.npy' % t)
+                if not os.path.exists(index_path):
+                    self.packs[t] = ({}, None)
+                else:
+                    index = {
+                        (int(e['z']), int(e['y']), int(e['x'])):
+                            (int(e['offset']), int(e['length']))
+                        for e in np.load(index_path)}
+                    data = np.memmap(os.path.join(self.root, '%d.bin' % t),
+                                     dtype=np.uint8, mode='r')
+                    self.packs[t] = (index, data)
+            return self.packs[t]
+
+    def _read_many(self, t, block_keys):
+        index, data = self._get_pack(t)
+        blocks = {}
+        for block_key in block_keys:
+            entry = index.get(block_key)
+            if entry is not None:
+                offset, length = entry
+                blocks[block_key] = _array_from_npy_buffer(
+                    data[offset:offset+length])
+        return blocks
+
+    def _write(self, t, blocks):
+        # all blocks of a threshold are packed together, so writing replaces
+        # the blocks packed before
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, '%d.bin' % t)
+        index = []
+        with open(path + '.tmp', 'wb') as f:
+            for roi_begin, edges in sorted(
+                    blocks.items(), key=lambda item: _block_key(item[0])):
+                buf = io.BytesIO()
+                np.save(buf, np.ascontiguousarray(edges, dtype=np.uint64))
+                index.append(_block_key(roi_begin) + (f.tell(), buf.tell()))
+                f.write(buf.getbuffer())
+        os.replace(path + '.tmp', path)
+        # the index is written last so that readers never see a partial pack
+        _save_npy(os.path.join(self.root, '%d.index.npy' % t),
+                  np.array(index, dtype=PACKED_INDEX_DTYPE))
+        with self.lock:
+            self.packs.pop(t, None)
+
+
+def copy_blockstore(src, dst):
+    '''Writes a ``{threshold: {roi_begin: edges}}`` mapping, e.g. an
+    in-memory blockstore, into the blockstore `dst`'''
+    for threshold, blocks in src.items():
+        dst.write(threshold, blocks)
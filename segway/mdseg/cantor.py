@@ -0,0 +1,51 @@
+'''Vectorized versions of `funlib.math.cantor_number` and
+`funlib.math.inv_cantor_number` for 3-dimensional block indices.
+
+The 3D Cantor number of (z, y, x) is ``P3(z+y+x) + P2(z+y) + z`` with the
+pyramid volumes ``P3(n) = n(n+1)(n+2)/6`` and ``P2(n) = n(n+1)/2``. Both are
+evaluated with exact integer arithmetic; the inverse uses a floating point
+estimate that is then corrected to the exact integer root.
+'''
+import numpy as np
+
+
+def _pyramid_volume_3(n):
+    return n * (n + 1) * (n + 2) // 6
+
+
+def _pyramid_volume_2(n):
+    return n * (n + 1) // 2
+
+
+def _inv_pyramid_volume(c, pyramid_volume, estimate):
+    '''Largest n with ``pyramid_volume(n) <= c``, elementwise'''
+    n = np.maximum(estimate.astype(np.int64) - 1, 0)
+    while True:
+        step = pyramid_volume(n + 1) <= c
+        if not step.any():
+            break
+        n += step
+    while True:
+        step = pyramid_volume(n) > c
+        if not step.any():
+            break
+        n -= step
+    return n
+
+
+def cantor_numbers(indices):
+    '''Returns the Cantor number of each row of an (n, 3) index array'''
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+    z, y, x = indices[:, 0], indices[:, 1], indices[:, 2]
+    return _pyramid_volume_3(z + y + x) + _pyramid_volume_2(z + y) + z
+
+
+def inv_cantor_numbers(c):
+    '''Returns the (n, 3) block indices of an array of Cantor numbers'''
+    c = np.asarray(c, dtype=np.int64).reshape(-1)
+    n = _inv_pyramid_volume(c, _pyramid_volume_3, np.cbrt(6.0 * c))
+    r = c - _pyramid_volume_3(n)
+    m = _inv_pyramid_volume(
+        r, _pyramid_volume_2, (np.sqrt(8.0 * r + 1) - 1) / 2)
+    z = r - _pyramid_volume_2(m)
+    return np.stack([z, m - z, n - m], axis=1)
@@ -1,17 +1,54 @@
+import itertools
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import numpy as np
-from cachetools import cached, RRCache
+from cachetools import LRUCache
 
 from funlib.geometry import Roi, Coordinate
 from funlib.math import cantor_number, inv_cantor_number
 
+from .cantor import cantor_numbers, inv_cantor_numbers
+from .lut_io import open_lut_reader, save_arrays, load_arrays, SCORED_EDGES_DIR
+from .lut_index import ComponentIndex, AdjacencyIndex, component_index_from_edges
+from .lut_cache import LUTCache
+from .lut_prefetch import LUTPrefetcher
+from .instrumentation import NullInstrumentation
+
+GLOBAL_LABEL_ARRAYS = ['fragments', 'offsets', 'sorted_fragments', 'sorted_labels']
+
+AXES = 'zyx'
+
+logger = logging.getLogger(__name__)
+
 def check_blocksize_consistency(big_bs, small_bs):
     assert len(big_bs) == len(small_bs)
     for a, b in zip(big_bs, small_bs):
         assert a % b == 0
 
 
+def get_locked_axes(z_only=False, locked_axes=None):
+    '''Returns the sorted dimensions (0 for z, 1 for y, 2 for x) along which
+    a grow must stay in the super block of the fragment it grows from.
+    `locked_axes` is any subset of 'zyx' (e.g. 'yx') or of the dimensions;
+    `z_only` is the same as locking y and x.'''
+    axes = set()
+    if z_only:
+        axes.update((1, 2))
+    for axis in locked_axes or ():
+        if isinstance(axis, str):
+            if axis not in AXES:
+                raise ValueError(f'Unknown axis {axis}, expected one of {AXES}')
+            axis = AXES.index(axis)
+        elif axis not in range(len(AXES)):
+            raise ValueError(f'Unknown axis {axis}, expected 0, 1 or 2')
+        axes.add(int(axis))
+    return sorted(axes)
+
+
 class ConnectedSegmentServer():
 
     def __init__(
@@ -26,9 +63,58 @@ class ConnectedSegmentServer():
             super_offset_hack=(0, 0, 0),
             base_threshold=0.5,
             block_index_offset=0,
+            lut_format='npz',
+            cache_bytes=4*1024*1024*1024,
+            prefetch=False,
+            prefetch_threads=2,
+            prefetch_bytes=None,
+            global_labels=False,
+            load_threads=8,
+            instrumentation=None,
+            scored_edges=False,
+            shared_registry=None,
+            missing_cache_size=100000,
+            manifest=False,
             ):
 
         self.super_lut_pre = os.path.join(hierarchy_lut_path, super_lut_pre)
+        self.lut_format = lut_format
+        self.lut_readers = {}
+        # blocks without a LUT file (outside of the volume or unprocessed)
+        # are treated as empty; known-missing blocks are remembered, or, with
+        # `manifest`, every LUT directory is listed once on first use
+        self.missing_blocks = LRUCache(maxsize=missing_cache_size)
+        self.missing_lock = Lock()
+        self.manifest = manifest
+        self.manifests = {}
+        # decoded blocks can be shared with the servers of other processes
+        # through a `SharedLUTRegistry`
+        self.shared_registry = shared_registry
+        on_evict = None
+        if shared_registry is not None:
+            on_evict = self._release_shared_block
+        self.lut_cache = LUTCache(cache_bytes, on_evict=on_evict)
+        if instrumentation is None:
+            instrumentation = NullInstrumentation()
+        self.instrumentation = instrumentation
+        self.global_labels = global_labels
+        # with scored edges, one cached edge block serves all thresholds
+        self.scored_edges = scored_edges
+        self.global_component_indexes = {}
+        self.load_executor = None
+        if load_threads > 1:
+            # blocks missing from the cache for one query are loaded
+            # concurrently; np.load releases the GIL while decompressing
+            self.load_executor = ThreadPoolExecutor(
+                max_workers=load_threads, thread_name_prefix='lut_load')
+        self.prefetcher = None
+        if prefetch:
+            # neighboring super blocks are loaded in the background, as
+            # consecutive grows mostly trace along a neurite
+            self.prefetcher = LUTPrefetcher(
+                self.lut_cache,
+                num_workers=prefetch_threads,
+                max_bytes=prefetch_bytes)
 
         check_blocksize_consistency(find_segment_block_size, fragments_block_size)
         check_blocksize_consistency(super_block_size, fragments_block_size)
@@ -64,73 +150,295 @@ class ConnectedSegmentServer():
         block_id = int(cantor_number(block_index))
         return block_id + self.block_index_offset
 
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+        if self.load_executor is not None:
+            self.load_executor.shutdown(wait=True)
+        if self.shared_registry is not None:
+            self.lut_cache.clear()
+
+    def get_lut_reader(self, lut_dir):
+        if lut_dir not in self.lut_readers:
+            # only blocks may be missing; a missing directory is a wrong
+            # path or a threshold without a LUT
+            if not os.path.isdir(lut_dir):
+                raise FileNotFoundError(f'LUT directory {lut_dir} does not exist')
+            self.lut_readers[lut_dir] = open_lut_reader(lut_dir, self.lut_format)
+        return self.lut_readers[lut_dir]
+
+    def get_manifest(self, lut_dir):
+        '''Returns the set of block ids that exist in `lut_dir`'''
+        if lut_dir not in self.manifests:
+            self.manifests[lut_dir] = set(self.get_lut_reader(lut_dir).block_ids())
+        return self.manifests[lut_dir]
+
+    def read_lut_block(self, lut_dir, read_method, super_block_id):
+        '''Returns ``reader.<read_method>(super_block_id)`` for the reader of
+        `lut_dir`, or None if the block does not exist. Raises
+        FileNotFoundError if `lut_dir` does not exist.'''
+        reader = self.get_lut_reader(lut_dir)
+        if self.manifest:
+            if super_block_id not in self.get_manifest(lut_dir):
+                self.instrumentation.count('blocks_missing')
+                return None
+        else:
+            with self.missing_lock:
+                missing = (lut_dir, super_block_id) in self.missing_blocks
+            if missing:
+                self.instrumentation.count('blocks_missing')
+                return None
+        try:
+            return getattr(reader, read_method)(super_block_id)
+        except FileNotFoundError:
+            logger.debug("No LUT block %d in %s" % (super_block_id, lut_dir))
+            self.instrumentation.count('blocks_missing')
+            with self.missing_lock:
+                self.missing_blocks[(lut_dir, super_block_id)] = True
+            return None
+
+    def id2indices(self, block_ids):
+        '''Vectorized `id2index`, returns an (n, 3) array'''
+        return inv_cantor_numbers(
+            np.asarray(block_ids, dtype=np.int64) + self.block_index_offset)
+
+    def index2ids(self, block_indices):
+        '''Vectorized `index2id`'''
+        return cantor_numbers(block_indices) + self.block_index_offset
+
+    def get_super_indices(self, fragment_ids):
+        '''Decodes an array of fragment ids into an (n, 3) array of super
+        block indices'''
+        with self.instrumentation.timer('decode'):
+            fragment_ids = np.asarray(fragment_ids).astype(np.uint64)
+            block_ids = fragment_ids // np.uint64(self.num_voxels_in_fragment_block)
+            fragment_index = self.id2indices(block_ids.astype(np.int64))
+            fragment_index -= np.asarray(self.super_offset_frag_nblock)
+            local_index = fragment_index // np.asarray(self.local_chunk_size)
+            return local_index // np.asarray(self.super_chunk_size)
+
     def get_super_index(self, fragment_id):
-        super_id = int(fragment_id)
-        print("super_id:", super_id)
-        block_id = int(super_id / self.num_voxels_in_fragment_block)
-        print("block_id:", block_id)
-        fragment_index = Coordinate(self.id2index(block_id))
-        print("fragment_index:", fragment_index)
-        fragment_index -= self.super_offset_frag_nblock
-        print("adjusted fragment_index:", fragment_index)
-        local_index = fragment_index // self.local_chunk_size
-        print("self.local_chunk_size:", self.local_chunk_size)
-        print("local_index:", local_index)
-        super_index = local_index // self.super_chunk_size
-        print("self.super_chunk_size:", self.super_chunk_size)
-        print("super_index:", super_index)
-        return super_index
-
-    @cached(cache=RRCache(maxsize=128*1024*1024))
-    def get_base_subsegments(
-            self,
-            super_fragment_id,
-            threshold,
-            ):
-        super_index = self.get_super_index(super_fragment_id)
-        super_block_id = self.index2id(super_index)
+        return Coordinate(self.get_super_indices([fragment_id])[0])
+
+    def cache_stats(self):
+        '''Returns hit/miss/eviction counters and memory use of the LUT cache'''
+        return self.lut_cache.stats()
 
+    def get_threshold_map_dir(self, threshold, prefix='threshold_map'):
         super_lut_dir = self.super_lut_pre + '_%d' % int(self.base_threshold*100)
-        lut_file = os.path.join(
-            super_lut_dir,
-            'threshold_map_%d' % int(threshold*100),
-            str(super_block_id) + '.npz')
-        # print("Loading", lut_file)
-        connected_components = np.load(lut_file, allow_pickle=True)['threshold_map']
-
-        for cc in connected_components:
-            if super_fragment_id in cc:
-                # print(cc)
-                return cc
-
-        # assert False
-        return []
-
-    @cached(cache=RRCache(maxsize=128*1024*1024))
-    def get_super_cc(
+        return os.path.join(super_lut_dir, prefix + '_%d' % int(threshold*100))
+
+    def get_component_index(self, threshold, super_block_id):
+        return self.lut_cache.get_or_load(
+            ('threshold_map', threshold, super_block_id),
+            self._load_component_index, threshold, super_block_id)
+
+    def _load_shared_block(self, kind, read_fn, threshold, super_block_id):
+        '''Returns the block from the shared registry, reading and sharing
+        it first if no process did yet'''
+        if self.shared_registry is None:
+            return read_fn(threshold, super_block_id)
+        key = '%s:%s:%s:%s:%s:%s' % (
+            self.super_lut_pre, self.lut_format, self.scored_edges,
+            kind, threshold, super_block_id)
+        arrays = self.shared_registry.get(key)
+        if arrays is None:
+            block = read_fn(threshold, super_block_id)
+            arrays = self.shared_registry.put(key, block.arrays())
+            if arrays is None:
+                # larger than the registry budget
+                return block
+        if kind == 'edges':
+            block = AdjacencyIndex.from_arrays(**arrays)
+        else:
+            block = ComponentIndex(**arrays)
+        block.shared_key = key
+        return block
+
+    def _release_shared_block(self, key, block):
+        shared_key = getattr(block, 'shared_key', None)
+        if shared_key is not None:
+            self.shared_registry.release(shared_key)
+
+    def _load_component_index(self, threshold, super_block_id):
+        return self._load_shared_block(
+            'threshold_map', self._read_component_index, threshold, super_block_id)
+
+    def _read_component_index(self, threshold, super_block_id):
+        lut_dir = self.get_threshold_map_dir(threshold)
+        if self.scored_edges and not os.path.isdir(lut_dir):
+            # thresholds without a precomputed threshold map are answered
+            # with the components of the block's edges up to `threshold`
+            adjacency = self.get_adjacency(threshold, super_block_id)
+            return component_index_from_edges(adjacency.edges(max_score=threshold))
+        index = self.read_lut_block(lut_dir, 'read_component_index', super_block_id)
+        if index is None:
+            return ComponentIndex(
+                np.zeros(0, dtype=np.uint64), np.zeros(1, dtype=np.int64))
+        return index
+
+    def get_global_component_index(self, threshold):
+        '''Returns the dataset-wide component index written by
+        `build_global_labels`, memory-mapped'''
+        if threshold not in self.global_component_indexes:
+            self.global_component_indexes[threshold] = ComponentIndex(
+                **load_arrays(
+                    self.get_threshold_map_dir(threshold, 'global_threshold_map'),
+                    GLOBAL_LABEL_ARRAYS))
+        return self.global_component_indexes[threshold]
+
+    def build_global_labels(self, threshold):
+        '''Offline step that merges all ``threshold_map`` blocks at
+        `threshold` into one fragment -> segment labeling covering the
+        dataset, saved as memory-mappable arrays in
+        ``global_threshold_map_XX``. With `global_labels=True`, membership
+        and segment expansion are then answered with `np.searchsorted`
+        regardless of the block layout.'''
+        reader = self.get_lut_reader(self.get_threshold_map_dir(threshold))
+
+        members = [np.zeros(0, dtype=np.uint64)]
+        member_offsets = [np.zeros(1, dtype=np.int64)]
+        lookup_fragments = [np.zeros(0, dtype=np.uint64)]
+        lookup_labels = [np.zeros(0, dtype=np.int64)]
+        num_labels = 0
+        num_members = 0
+        for super_block_id in reader.block_ids():
+            fragments, offsets = reader.read_components(super_block_id)
+            fragments = np.asarray(fragments, dtype=np.uint64)
+            offsets = np.asarray(offsets, dtype=np.int64)
+            labels = np.repeat(
+                np.arange(len(offsets) - 1, dtype=np.int64) + num_labels,
+                np.diff(offsets))
+            # like `get_base_subsegments`, a fragment is labeled by the
+            # components of the super block it belongs to
+            own = self.index2ids(self.get_super_indices(fragments)) == super_block_id
+            lookup_fragments.append(fragments[own])
+            lookup_labels.append(labels[own])
+            members.append(fragments)
+            member_offsets.append(offsets[1:] + num_members)
+            num_labels += len(offsets) - 1
+            num_members += len(fragments)
+
+        lookup_fragments = np.concatenate(lookup_fragments)
+        lookup_labels = np.concatenate(lookup_labels)
+        order = np.argsort(lookup_fragments, kind='stable')
+        lookup_fragments = lookup_fragments[order]
+        lookup_labels = lookup_labels[order]
+        first = np.ones(len(lookup_fragments), dtype=bool)
+        first[1:] = lookup_fragments[1:] != lookup_fragments[:-1]
+
+        save_arrays(
+            self.get_threshold_map_dir(threshold, 'global_threshold_map'),
+            {
+                'fragments': np.concatenate(members),
+                'offsets': np.concatenate(member_offsets),
+                'sorted_fragments': lookup_fragments[first],
+                'sorted_labels': lookup_labels[first],
+            })
+        self.global_component_indexes.pop(threshold, None)
+
+    def get_segment_labels(self, fragment_ids, threshold):
+        '''Returns the global segment label of each fragment at `threshold`,
+        or -1 for fragments that are not part of a segment'''
+        return self.get_global_component_index(threshold).find_components(
+            np.asarray(fragment_ids, dtype=np.uint64))
+
+    def get_base_subsegments(
             self,
             super_fragment_id,
             threshold,
             ):
-
-        super_index = self.get_super_index(super_fragment_id)
-        super_block_id = self.index2id(super_index)
-        print("super_block_id:", super_block_id)
+        if self.global_labels:
+            index = self.get_global_component_index(threshold)
+        else:
+            super_index = self.get_super_index(super_fragment_id)
+            super_block_id = self.index2id(super_index)
+            index = self.get_component_index(threshold, super_block_id)
+
+        label = index.find_component(super_fragment_id)
+        if label < 0:
+            return []
+        return index.get_component(label).tolist()
+
+    def _get_many(self, kind, load_fn, threshold, super_block_ids):
+        '''Returns {super_block_id: block} for the given blocks, loading all
+        blocks missing from the cache concurrently'''
+        blocks = {}
+        missing = []
+        with self.instrumentation.timer('cache_probe'):
+            for super_block_id in super_block_ids:
+                block = self.lut_cache.get((kind, threshold, super_block_id))
+                if block is None:
+                    missing.append(super_block_id)
+                else:
+                    blocks[super_block_id] = block
+        self.instrumentation.count('blocks_cached', len(blocks))
+        self.instrumentation.count('blocks_loaded', len(missing))
+
+        with self.instrumentation.timer('load'):
+            if self.load_executor is not None and len(missing) > 1:
+                futures = [
+                    self.load_executor.submit(load_fn, threshold, super_block_id)
+                    for super_block_id in missing]
+                loaded = [f.result() for f in futures]
+            else:
+                loaded = [load_fn(threshold, super_block_id)
+                          for super_block_id in missing]
+
+        for super_block_id, block in zip(missing, loaded):
+            self.lut_cache.put((kind, threshold, super_block_id), block)
+            blocks[super_block_id] = block
+        return blocks
+
+    def get_component_indexes(self, threshold, super_block_ids):
+        return self._get_many(
+            'threshold_map', self._load_component_index, threshold, super_block_ids)
+
+    def get_edges_threshold(self, threshold):
+        '''Returns the threshold under which the edges needed at `threshold`
+        are cached (None for scored edges, which serve all thresholds)'''
+        if self.scored_edges:
+            return None
+        return threshold
+
+    def get_max_score(self, threshold):
+        '''Returns the score up to which scored edges exist at `threshold`'''
+        if self.scored_edges:
+            return threshold
+        return None
+
+    def get_adjacencies(self, threshold, super_block_ids):
+        return self._get_many(
+            'edges', self._load_adjacency,
+            self.get_edges_threshold(threshold), super_block_ids)
+
+    def get_adjacency(self, threshold, super_block_id):
+        threshold = self.get_edges_threshold(threshold)
+        return self.lut_cache.get_or_load(
+            ('edges', threshold, super_block_id),
+            self._load_adjacency, threshold, super_block_id)
+
+    def _load_adjacency(self, threshold, super_block_id):
+        return self._load_shared_block(
+            'edges', self._read_adjacency, threshold, super_block_id)
+
+    def _read_adjacency(self, threshold, super_block_id):
+        if self.scored_edges:
+            super_lut_dir = self.super_lut_pre + '_%d' % int(self.base_threshold*100)
+            lut_dir = os.path.join(super_lut_dir, SCORED_EDGES_DIR)
+            adjacency = self.read_lut_block(
+                lut_dir, 'read_scored_adjacency', super_block_id)
+            if adjacency is None:
+                return AdjacencyIndex(
+                    np.zeros((0, 2), dtype=np.uint64), np.zeros(0, dtype=np.float32))
+            return adjacency
 
         super_lut_dir = self.super_lut_pre + '_%d' % int(threshold*100)
-        lut_file = os.path.join(super_lut_dir, 'edges_super2super', str(super_block_id) + '.npz')
-        print("Loading", lut_file)
-        lut = np.load(lut_file)['edges']
-
-        print(lut)
-        # asdf
-
-        cc = []
-        for edge in lut:
-            if edge[0] == super_fragment_id:
-                cc.append(edge[1])
-            if edge[1] == super_fragment_id:
-                cc.append(edge[0])
+        lut_dir = os.path.join(super_lut_dir, 'edges_super2super')
+        # npy and sharded blocks map their stored CSR arrays in place
+        adjacency = self.read_lut_block(lut_dir, 'read_adjacency', super_block_id)
+        if adjacency is None:
+            return AdjacencyIndex(np.zeros((0, 2), dtype=np.uint64))
 
         # lut_file = os.path.join(super_lut_dir, 'nodes_super', str(super_block_id) + '.npz')
         # # print("Loading", lut_file)
@@ -147,7 +455,112 @@ class ConnectedSegmentServer():
         # lut = np.load(lut_file)['edges']
         # print("edges_super2local:", lut)
 
-        return cc
+        return adjacency
+
+    def get_super_cc(
+            self,
+            super_fragment_id,
+            threshold,
+            ):
+
+        super_index = self.get_super_index(super_fragment_id)
+        super_block_id = self.index2id(super_index)
+
+        adjacency = self.get_adjacency(threshold, super_block_id)
+        return adjacency.neighbors(
+            super_fragment_id, max_score=self.get_max_score(threshold)).tolist()
+
+    def group_by_super_block(self, fragment_ids):
+        '''Yields (super_block_id, fragment_ids) for every super block that
+        the given fragments fall into'''
+        fragment_ids = np.asarray(fragment_ids, dtype=np.uint64)
+        if len(fragment_ids) == 0:
+            return
+        block_ids = self.index2ids(self.get_super_indices(fragment_ids))
+        order = np.argsort(block_ids, kind='stable')
+        block_ids, starts = np.unique(block_ids[order], return_index=True)
+        groups = np.split(fragment_ids[order], starts[1:])
+        for block_id, group in zip(block_ids, groups):
+            yield int(block_id), group
+
+    def filter_locked_axes(self, sources, neighbors, locked_axes):
+        '''Returns the mask of neighbors that are in the same super block as
+        their source fragment along all `locked_axes`'''
+        if len(locked_axes) == 0:
+            return np.ones(len(neighbors), dtype=bool)
+        source_index = self.get_super_indices(sources)[:, locked_axes]
+        neighbor_index = self.get_super_indices(neighbors)[:, locked_axes]
+        return (source_index == neighbor_index).all(axis=1)
+
+    def _get_super_cc_many(self, fragment_ids, locked_axes=()):
+        '''Returns the neighbors of all given fragments at the base
+        threshold, loading each super block once'''
+        neighbors = [np.zeros(0, dtype=np.uint64)]
+        groups = list(self.group_by_super_block(fragment_ids))
+        adjacencies = self.get_adjacencies(
+            self.base_threshold, [super_block_id for super_block_id, _ in groups])
+        max_score = self.get_max_score(self.base_threshold)
+        with self.instrumentation.timer('scan'):
+            for super_block_id, group in groups:
+                sources, adjacent = adjacencies[super_block_id].neighbors_many(
+                    group, max_score=max_score)
+                adjacent = adjacent.astype(np.uint64)
+
+                if len(locked_axes):
+                    adjacent = adjacent[
+                        self.filter_locked_axes(sources, adjacent, locked_axes)]
+
+                neighbors.append(adjacent)
+            return np.concatenate(neighbors)
+
+    def _get_base_subsegments_many(self, fragment_ids, threshold, no_grow):
+        '''Returns the members of all components at `threshold` containing
+        the given fragments, except components with a no-grow fragment'''
+        if self.global_labels:
+            index = self.get_global_component_index(threshold)
+            with self.instrumentation.timer('scan'):
+                return self._expand_components(index, fragment_ids, no_grow)
+
+        members = [np.zeros(0, dtype=np.uint64)]
+        groups = list(self.group_by_super_block(fragment_ids))
+        indexes = self.get_component_indexes(
+            threshold, [super_block_id for super_block_id, _ in groups])
+        with self.instrumentation.timer('scan'):
+            for super_block_id, group in groups:
+                members.append(
+                    self._expand_components(indexes[super_block_id], group, no_grow))
+            return np.concatenate(members)
+
+    def _expand_components(self, index, fragment_ids, no_grow):
+        labels = np.unique(index.find_components(fragment_ids))
+        labels = labels[labels >= 0]
+        members = index.get_components(labels).astype(np.uint64)
+        # a component may list no-grow fragments that the index labels with
+        # another block's component, so they are searched among the members
+        member_labels = np.repeat(labels, index.offsets[labels + 1] - index.offsets[labels])
+        blocked = member_labels[np.isin(members, no_grow)]
+        return members[~np.isin(member_labels, blocked)]
+
+    def prefetch_neighbor_blocks(self, fragment_ids, threshold):
+        '''Queues the 26 spatial neighbors of the super blocks of
+        `fragment_ids` for background loading'''
+        if self.prefetcher is None or len(fragment_ids) == 0:
+            return
+        super_indices = np.unique(self.get_super_indices(fragment_ids), axis=0)
+        offsets = np.array([
+            d for d in itertools.product((-1, 0, 1), repeat=3) if any(d)])
+        neighbors = (super_indices[:, None, :] + offsets[None, :, :]).reshape(-1, 3)
+        neighbors = np.unique(neighbors[(neighbors >= 0).all(axis=1)], axis=0)
+        edges_threshold = self.get_edges_threshold(self.base_threshold)
+        for super_block_id in self.index2ids(neighbors).tolist():
+            self.prefetcher.prefetch(
+                ('edges', edges_threshold, super_block_id),
+                self._load_adjacency, edges_threshold, super_block_id)
+            # with global labels, components are not read per block
+            if threshold != self.base_threshold and not self.global_labels:
+                self.prefetcher.prefetch(
+                    ('threshold_map', threshold, super_block_id),
+                    self._load_component_index, threshold, super_block_id)
 
     def find_connected_super_fragments(
             self,
@@ -156,59 +569,71 @@ class ConnectedSegmentServer():
 
             threshold,
             z_only=False,
+            grow_to_closure=False,
+            max_closure_nodes=100000,
+            max_closure_time=2.0,
+            locked_axes=None,
             ):
-
-        connected_components = []
-        processed_components = set()
-        no_grow_super_fragments = [int(n) for n in no_grow_super_fragments]
-        no_grow_super_fragments = set(no_grow_super_fragments)
-        selected_super_fragments = [int(n) for n in selected_super_fragments]
-
-        for selected_super in selected_super_fragments:
-
-            if selected_super == 0:
-                continue
-            if selected_super in processed_components:
-                continue
-
-            processed_components.add(selected_super)
-
-            connected_components.append(selected_super)
-
-            if selected_super in no_grow_super_fragments:
-                continue
-
-            cc = self.get_super_cc(selected_super, threshold=self.base_threshold)
-
-            if z_only:
-                selected_super_index = self.get_super_index(selected_super)
-                selected_super_index = (selected_super_index[1], selected_super_index[2])
-                filtered = []
-                for component in cc:
-                    index = self.get_super_index(component)
-                    index = (index[1], index[2])
-                    if index == selected_super_index:
-                        filtered.append(component)
-                cc = filtered
-
-            cc = set(cc) - no_grow_super_fragments
-
-            connected_components.extend(cc)
-
-        connected_components = set(connected_components)
-
-        # print("connected_components:", connected_components)
-        if threshold != self.base_threshold:
-            base_components = []
-            for component in connected_components:
-                # print("component:", component)
-                tmp = set(self.get_base_subsegments(component, threshold))
-                if tmp.isdisjoint(no_grow_super_fragments):
-                    base_components.extend(tmp)
-            connected_components |= set(base_components)
-
-        # return list(set(connected_components))
-        return list(connected_components)
+        '''Grows the selection by one hop of super fragment edges plus the
+        base subsegments at `threshold`. With `grow_to_closure`, the grow is
+        repeated until the whole connected component is selected, or until
+        `max_closure_nodes` fragments or `max_closure_time` seconds are
+        reached (checked between hops). Edges leaving the super block along
+        `locked_axes` (see `get_locked_axes`) are not followed.'''
+
+        locked_axes = get_locked_axes(z_only, locked_axes)
+
+        no_grow_super_fragments = np.unique(np.array(
+            [int(n) for n in no_grow_super_fragments], dtype=np.uint64))
+        selected_super_fragments = np.unique(np.array(
+            [int(n) for n in selected_super_fragments], dtype=np.uint64))
+        selected_super_fragments = selected_super_fragments[
+            selected_super_fragments != 0]
+
+        if self.prefetcher is not None:
+            # foreground queries take precedence over queued prefetches
+            self.prefetcher.cancel()
+
+        to_grow = selected_super_fragments[
+            ~np.isin(selected_super_fragments, no_grow_super_fragments)]
+
+        self.instrumentation.count('grows')
+        self.instrumentation.count('selected_fragments', len(selected_super_fragments))
+
+        start_time = time.time()
+        connected_components = selected_super_fragments
+        frontier = to_grow
+        to_expand = selected_super_fragments
+        while True:
+            cc = self._get_super_cc_many(frontier, locked_axes=locked_axes)
+            cc = cc[~np.isin(cc, no_grow_super_fragments)]
+
+            if threshold != self.base_threshold:
+                base_components = self._get_base_subsegments_many(
+                    np.union1d(to_expand, cc), threshold, no_grow_super_fragments)
+                cc = np.union1d(cc, base_components)
+
+            with self.instrumentation.timer('merge'):
+                new_components = np.setdiff1d(cc, connected_components)
+                connected_components = np.union1d(connected_components, new_components)
+
+            if not grow_to_closure or len(new_components) == 0:
+                break
+            if (len(connected_components) >= max_closure_nodes
+                    or time.time() - start_time >= max_closure_time):
+                logger.info(
+                    "Stopped growing to closure at %d fragments after %.2fs" % (
+                        len(connected_components), time.time() - start_time))
+                break
+
+            # new fragments never contain no-grow fragments
+            frontier = new_components
+            to_expand = new_components
+
+        self.prefetch_neighbor_blocks(frontier, threshold)
+        self.instrumentation.record_time('grow', time.time() - start_time)
+
+        return connected_components.tolist()
 
 
 if __name__ == "__main__":
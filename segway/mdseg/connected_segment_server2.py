@@ -1,11 +1,20 @@
+import logging
 import os
+import time
 
 import numpy as np
-from cachetools import cached, RRCache
 
 from funlib.geometry import Roi, Coordinate
 from funlib.math import cantor_number, inv_cantor_number
 
+from .cantor import cantor_numbers, inv_cantor_numbers
+from .lut_index import AdjacencyIndex
+from .lut_cache import LUTCache
+from .instrumentation import NullInstrumentation
+from .connected_segment_server import get_locked_axes
+
+logger = logging.getLogger(__name__)
+
 def check_blocksize_consistency(big_bs, small_bs):
     assert len(big_bs) == len(small_bs)
     for a, b in zip(big_bs, small_bs):
@@ -27,6 +36,8 @@ class ConnectedSegmentServer():
             base_threshold=0.5,
             cantor_number_offset=0,
             debug_voxel_size=None,
+            instrumentation=None,
+            cache_bytes=1024*1024*1024,
             ):
 
         self.super_lut_pre = os.path.join(hierarchy_lut_path, super_lut_pre)
@@ -36,6 +47,10 @@ class ConnectedSegmentServer():
         debug_voxel_size = Coordinate(debug_voxel_size)
 
         self.blockstore = blockstore
+        self.lut_cache = LUTCache(cache_bytes)
+        if instrumentation is None:
+            instrumentation = NullInstrumentation()
+        self.instrumentation = instrumentation
 
         check_blocksize_consistency(find_segment_block_size, fragments_block_size)
         check_blocksize_consistency(super_block_size, fragments_block_size)
@@ -78,31 +93,60 @@ class ConnectedSegmentServer():
         block_id = int(cantor_number(block_index))
         return block_id + self.cantor_number_offset
 
+    def id2indices(self, block_ids):
+        '''Vectorized `id2index`, returns an (n, 3) array'''
+        return inv_cantor_numbers(
+            np.asarray(block_ids, dtype=np.int64) - self.cantor_number_offset)
+
+    def index2ids(self, block_indices):
+        '''Vectorized `index2id`'''
+        return cantor_numbers(block_indices) + self.cantor_number_offset
+
+    def get_super_indices(self, fragment_ids):
+        '''Decodes an array of fragment ids into an (n, 3) array of super
+        block indices'''
+        with self.instrumentation.timer('decode'):
+            fragment_ids = np.asarray(fragment_ids).astype(np.uint64)
+            block_ids = fragment_ids // np.uint64(self.num_voxels_in_fragment_block)
+            fragment_index = self.id2indices(block_ids.astype(np.int64))
+            fragment_index -= np.asarray(self.super_offset_frag_nblock)
+            local_index = fragment_index // np.asarray(self.local_chunk_size)
+            return local_index // np.asarray(self.super_chunk_size)
+
     def get_super_index(self, fragment_id):
-        super_id = int(fragment_id)
-        print("super_id:", super_id)
-        block_id = int(super_id / self.num_voxels_in_fragment_block)
-        print("block_id:", block_id)
-        fragment_index = Coordinate(self.id2index(block_id))
-        print("fragment_index:", fragment_index)
-        fragment_index -= self.super_offset_frag_nblock
-        print("adjusted fragment_index:", fragment_index)
-        local_index = fragment_index // self.local_chunk_size
-        print("self.local_chunk_size:", self.local_chunk_size)
-        print("local_index:", local_index)
-        super_index = local_index // self.super_chunk_size
-        print("self.super_chunk_size:", self.super_chunk_size)
-        print("super_index:", super_index)
-        return super_index
+        return Coordinate(self.get_super_indices([fragment_id])[0])
 
     def get_roi_fragments(self, fragment_id):
-        chunk_id = int(fragment_id / self.num_voxels_in_fragment_block)
-        chunk_index = Coordinate(self.id2index(chunk_id))
-        print(f'chunk_index: {chunk_index}')
-        roi_begin = chunk_index*self.fragments_block_size
-        return Roi(roi_begin, self.fragments_block_size)
+        with self.instrumentation.timer('decode'):
+            chunk_id = int(fragment_id / self.num_voxels_in_fragment_block)
+            chunk_index = Coordinate(self.id2index(chunk_id))
+            roi_begin = chunk_index*self.fragments_block_size
+            return Roi(roi_begin, self.fragments_block_size)
+
+    def cache_stats(self):
+        '''Returns hit/miss/eviction counters and memory use of the
+        adjacency cache'''
+        return self.lut_cache.stats()
+
+    def get_adjacency(self, threshold, fragment_id):
+        '''Returns the adjacency index of the edges of the fragment block of
+        `fragment_id`, built once per (threshold, block) and shared by all
+        fragments of the block'''
+        chunk_id = int(fragment_id) // self.num_voxels_in_fragment_block
+        key = (threshold, chunk_id)
+        with self.instrumentation.timer('cache_probe'):
+            adjacency = self.lut_cache.get(key)
+        if adjacency is None:
+            roi = self.get_roi_fragments(fragment_id)
+            logger.debug("fragment %d roi: %s", fragment_id, roi)
+            self.instrumentation.count('blocks_loaded')
+            with self.instrumentation.timer('load'):
+                adjacency = AdjacencyIndex(self.blockstore[threshold][roi.begin])
+            self.lut_cache.put(key, adjacency)
+        else:
+            self.instrumentation.count('blocks_cached')
+        return adjacency
 
-    @cached(cache=RRCache(maxsize=128*1024*1024))
     def get_super_cc(
             self,
             fragment_id,
@@ -110,17 +154,9 @@ class ConnectedSegmentServer():
             ):
 
         # super_index = self.get_super_index(fragment_id)
-        roi = self.get_roi_fragments(fragment_id)
-        print(f'fragment roi: {roi}')
-        print(f'fragment roi (pix): {roi/self.debug_voxel_size}')
-        lut = self.blockstore[threshold][roi.begin]
-        adj_fragments = []
-        for edge in lut:
-            if edge[0] == fragment_id:
-                adj_fragments.append(edge[1])
-            if edge[1] == fragment_id:
-                adj_fragments.append(edge[0])
-        return adj_fragments
+        adjacency = self.get_adjacency(threshold, fragment_id)
+        with self.instrumentation.timer('scan'):
+            return adjacency.neighbors(fragment_id).tolist()
 
     def find_connected_super_fragments(
             self,
@@ -128,14 +164,48 @@ class ConnectedSegmentServer():
             no_grow_super_fragments,
             threshold,
             z_only=False,
+            grow_to_closure=False,
+            max_closure_nodes=100000,
+            max_closure_time=2.0,
+            locked_axes=None,
             ):
+        '''See connected_segment_server.ConnectedSegmentServer'''
 
-        connected_components = []
-        processed_components = set()
-        print(no_grow_super_fragments)
+        start_time = time.time()
+        locked_axes = get_locked_axes(z_only, locked_axes)
         no_grow_super_fragments = [int(n) for n in no_grow_super_fragments]
         no_grow_super_fragments = set(no_grow_super_fragments)
         selected_super_fragments = [int(n) for n in selected_super_fragments]
+        self.instrumentation.count('grows')
+        self.instrumentation.count('selected_fragments', len(selected_super_fragments))
+
+        connected_components = self._grow_once(
+            selected_super_fragments, no_grow_super_fragments, threshold, locked_axes)
+
+        # fragments grown into never contain no-grow fragments
+        frontier = connected_components - set(selected_super_fragments)
+        while grow_to_closure and len(frontier):
+            if (len(connected_components) >= max_closure_nodes
+                    or time.time() - start_time >= max_closure_time):
+                logger.info(
+                    "Stopped growing to closure at %d fragments after %.2fs" % (
+                        len(connected_components), time.time() - start_time))
+                break
+            frontier = self._grow_once(
+                frontier, no_grow_super_fragments, threshold, locked_axes
+                ) - connected_components
+            connected_components |= frontier
+
+        self.instrumentation.record_time('grow', time.time() - start_time)
+
+        # return list(set(connected_components))
+        return list(connected_components)
+
+    def _grow_once(self, selected_super_fragments, no_grow_super_fragments,
+                   threshold, locked_axes):
+        '''Returns the selection grown by one hop'''
+        connected_components = []
+        processed_components = set()
 
         for selected_super in selected_super_fragments:
 
@@ -153,16 +223,15 @@ class ConnectedSegmentServer():
 
             cc = self.get_super_cc(selected_super, threshold=self.base_threshold)
 
-            if z_only:
-                selected_super_index = self.get_super_index(selected_super)
-                selected_super_index = (selected_super_index[1], selected_super_index[2])
-                filtered = []
-                for component in cc:
-                    index = self.get_super_index(component)
-                    index = (index[1], index[2])
-                    if index == selected_super_index:
-                        filtered.append(component)
-                cc = filtered
+            if len(locked_axes) and len(cc):
+                # decode all neighbors at once and keep those in the same
+                # super block along the locked axes
+                selected_super_index = self.get_super_indices([selected_super])[0]
+                cc_index = self.get_super_indices(cc)
+                same_block = (
+                    cc_index[:, locked_axes] == selected_super_index[locked_axes]
+                    ).all(axis=1)
+                cc = np.asarray(cc, dtype=np.uint64)[same_block].tolist()
 
             cc = set(cc) - no_grow_super_fragments
 
@@ -180,6 +249,5 @@ class ConnectedSegmentServer():
                     base_components.extend(tmp)
             connected_components |= set(base_components)
 
-        # return list(set(connected_components))
-        return list(connected_components)
+        return connected_components
 
@@ -19,10 +19,10 @@ class KeyValueDatabase(object):
     def _get(self, key_list):
         raise RuntimeError("To be implemented")
 
-    def get_list(self, key_list):
-        return self._get_list(key_list)
+    def get_list(self, key_list, as_dict=False):
+        return self._get_list(key_list, as_dict=as_dict)
 
-    def _get_list(self, key_list):
+    def _get_list(self, key_list, as_dict=False):
         raise RuntimeError("To be implemented")
 
     def set(self, kv_list):
@@ -1,31 +1,44 @@
-import sqlite3
 from threading import Lock, RLock
 import pickle
 
+import numpy as np
+
 import logging
 logger = logging.getLogger(__name__)
 
 from .key_value_db import KeyValueDatabase
+from .sqlite_pool import SQLitePool
 
 class KeyValueDatabaseSQLite(KeyValueDatabase):
-    def __init__(self, db_file, collection_name):
+
+    # stays below SQLite's default limit of 999 parameters per statement
+    max_keys_per_query = 500
+
+    def __init__(self, db_file, collection_name, batch_size=10000,
+                 synchronous='NORMAL', cache_size_mib=64, max_connections=8):
         self.db_file = db_file
         self.collection_name = collection_name
+        # serializes writers, readers use their own connections
         self.lock = Lock()
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self.cache_size_mib = cache_size_mib
+        self.max_connections = max_connections
+        self.pool = None
         super().__init__()
 
     def connect(self):
         super().connect()
-        self.con = sqlite3.connect(self.db_file, check_same_thread=False)
-        self.con.row_factory = sqlite3.Row
-        self.cur = self.con.cursor()
+        self.pool = SQLitePool(
+            self.db_file,
+            max_connections=self.max_connections,
+            synchronous=self.synchronous,
+            cache_size_mib=self.cache_size_mib,
+            write_lock=self.lock)
 
     def close(self):
         super().close()
-        self.cur.close()
-        self.con.close()
-        self.cur = None
-        self.con = None
+        self.pool.close()
 
     # def _create_index(self, index_list):
         # if db_col_name not in self.database.list_collection_names():
@@ -35,12 +48,27 @@ class KeyValueDatabaseSQLite(KeyValueDatabase):
         #         ],
         #         name='id', unique=True)
     def _create_index(self):
-        with self.lock:
-            self.cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS id on {self.collection_name} (id)')
+        with self.pool.write() as con:
+            con.execute(f'CREATE TABLE IF NOT EXISTS {self.collection_name} (id INTEGER)')
+            con.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS id on {self.collection_name} (id)')
+
+    @staticmethod
+    def __pack_value(value):
+        if value is None or type(value) in [int, float, bool, str]:
+            return value
+        # numpy scalars, e.g. fragment ids, are stored as plain numbers
+        if isinstance(value, np.bool_):
+            return bool(value)
+        if isinstance(value, np.integer):
+            return int(value)
+        if isinstance(value, np.floating):
+            return float(value)
+        return pickle.dumps(value)
 
     @staticmethod
     def __unpack_string(data):
-        if type(data) in [int, bool, str]:
+        # NULL for columns that were added after an entry was written
+        if data is None or type(data) in [int, float, bool, str]:
             return data
         elif type(data) is bytes:
             return pickle.loads(data)
@@ -55,24 +83,78 @@ class KeyValueDatabaseSQLite(KeyValueDatabase):
 
     # def _get(self, key_list):
     #     return [k for k in self.superfragments.find({'id': {'$in': key_list}})]
-    def _get_list(self, key_list):
-        """Unfound keys are silently ignored"""
-        ret = []
-        for k in key_list:
-            res = self.cur.execute(f"SELECT * FROM {self.collection_name} "
-                                     "WHERE id=?", (k,)).fetchone()
-            if res is not None:
-                ret.append(self.__unpack_entry(res))
-        return ret
+    def _get_list(self, key_list, as_dict=False):
+        """Unfound keys are silently ignored. Entries are returned in the
+        order of `key_list`, or as a dict keyed by id with `as_dict`."""
+        # ids are stored as integers, keys may be strings or numpy ints
+        key_list = [int(k) for k in key_list]
+        unique_keys = list(dict.fromkeys(key_list))
+        found = {}
+        with self.pool.read() as con:
+            for i in range(0, len(unique_keys), self.max_keys_per_query):
+                chunk = unique_keys[i:i+self.max_keys_per_query]
+                placeholders = ', '.join(['?'] * len(chunk))
+                res = con.execute(f"SELECT * FROM {self.collection_name} "
+                                  f"WHERE id IN ({placeholders})", chunk)
+                for row in res.fetchall():
+                    entry = self.__unpack_entry(row)
+                    found[entry['id']] = entry
+        if as_dict:
+            return found
+        return [found[k] for k in key_list if k in found]
 
     def _get(self, key):
-        res = self.cur.execute(f"SELECT * FROM {self.collection_name} "
-                                 "WHERE id=?", (key,)).fetchone()
+        with self.pool.read() as con:
+            res = con.execute(f"SELECT * FROM {self.collection_name} "
+                               "WHERE id=?", (key,)).fetchone()
         if res is None:
             return None
         return self.__unpack_entry(res)
 
+    @staticmethod
+    def __quote(column):
+        '''Returns `column` as a quoted SQL identifier, so that entry keys
+        cannot inject SQL'''
+        return '"%s"' % column.replace('"', '""')
+
+    def __add_missing_columns(self, con, columns):
+        # SQLite column names are case insensitive
+        existing = set(row['name'].lower() for row in con.execute(
+            f'PRAGMA table_info({self.collection_name})'))
+        for c in columns:
+            if c.lower() not in existing:
+                con.execute(f'ALTER TABLE {self.collection_name} ADD COLUMN {self.__quote(c)}')
+                existing.add(c.lower())
+
     def _set(self, kv_list):
-        raise RuntimeError("To be implemented")
-        with self.lock:
-            pass
+        """Upserts entries, i.e. dicts with an `id` plus the columns to set,
+        in a single transaction. Returns the number of written entries."""
+        # entries setting the same columns are written with one statement
+        by_columns = {}
+        for entry in kv_list:
+            columns = tuple(entry.keys())
+            assert 'id' in columns, f'Entry {entry} has no id'
+            for c in columns:
+                if not isinstance(c, str):
+                    raise ValueError(f'Entry key {c!r} is not a string')
+            if isinstance(entry['id'], (bool, np.bool_)) or \
+                    not isinstance(entry['id'], (int, np.integer)):
+                raise ValueError(f"Entry id {entry['id']!r} is not an integer")
+            by_columns.setdefault(columns, []).append(
+                tuple(self.__pack_value(entry[c]) for c in columns))
+
+        with self.pool.write() as con:
+            self.__add_missing_columns(
+                con, set(c for columns in by_columns for c in columns))
+            for columns, rows in by_columns.items():
+                quoted = [self.__quote(c) for c in columns]
+                updates = ', '.join(
+                    f'{q}=excluded.{q}' for c, q in zip(columns, quoted) if c != 'id')
+                conflict = f'DO UPDATE SET {updates}' if updates else 'DO NOTHING'
+                command = (
+                    f"INSERT INTO {self.collection_name}({', '.join(quoted)}) "
+                    f"VALUES ({', '.join(['?'] * len(columns))}) "
+                    f"ON CONFLICT(id) {conflict}")
+                for i in range(0, len(rows), self.batch_size):
+                    con.executemany(command, rows[i:i+self.batch_size])
+        return sum(len(rows) for rows in by_columns.values())
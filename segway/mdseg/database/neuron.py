@@ -1,3 +1,5 @@
+from .segment_encoding import encode_segments, segment_list
+
 
 class Neuron():
 
@@ -131,11 +133,19 @@ class Neuron():
     def get_backup_name(self):
         return "%s.%d" % (self.name, self.version)
 
-    def to_json(self):
+    def to_json(self, segment_encoding=None):
+        '''With `segment_encoding` 'raw', 'zstd' or 'zlib', segment lists are
+        stored as binary columns (see segment_encoding.py) instead of id
+        strings'''
 
-        # need to convert numbers to string for json
-        segments = [str(k) for k in self.segments]
-        blacklist_segments = [str(k) for k in self.blacklist_segments]
+        if segment_encoding is None:
+            # need to convert numbers to string for json
+            segments = [str(k) for k in self.segments]
+            blacklist_segments = [str(k) for k in self.blacklist_segments]
+        else:
+            compression = None if segment_encoding == 'raw' else segment_encoding
+            segments = encode_segments(self.segments, compression)
+            blacklist_segments = encode_segments(self.blacklist_segments, compression)
 
         return {
             'neuron_name': self.name,
@@ -164,9 +174,9 @@ class Neuron():
     def from_dict(d):
         n = Neuron(d['neuron_name'])
         if 'segments' in d:
-            n.segments = [int(k) for k in d['segments']]
+            n.segments = segment_list(d['segments'])
         if 'blacklist_segments' in d:
-            n.blacklist_segments = [int(k) for k in d['blacklist_segments']]
+            n.blacklist_segments = segment_list(d['blacklist_segments'])
         if 'annotator' in d:
             n.annotator = d['annotator']
         if 'cell_type' in d:
@@ -1,6 +1,7 @@
 import logging
 
 from .neuron import Neuron
+from .segment_encoding import segment_list
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +62,27 @@ class NeuronDBServer():
     def _modify_segment_map(self, segment_ids, neuron_id):
         raise RuntimeError("To be implemented by derived class")
 
+    def _get_neuron_members(self, neuron_name, item, backup=False):
+        '''Returns {neuron name: (segments, blacklist_segments)} of the
+        neuron, whose record is `item`, and of its children. Derived classes
+        with a membership table answer this with one query.'''
+        members = {neuron_name: (
+            segment_list(item.get('segments', [])),
+            segment_list(item.get('blacklist_segments', [])))}
+        for c in self._get_children_of(neuron_name):
+            members[c['neuron_name']] = (
+                segment_list(c['segments']), segment_list(c['blacklist_segments']))
+        return members
+
+    def _get_mapped_neurons(self, segment_ids):
+        '''Returns {segment id: neuron name} of the mapped `segment_ids`'''
+        mappings = {}
+        for sid in segment_ids:
+            nid = self.__get_segment_map_cached(sid)
+            if nid is not None:
+                mappings[sid] = nid
+        return mappings
+
     def _count_prefix_in_db(prefix):
         raise RuntimeError("To be implemented by derived class")
 
@@ -93,22 +115,24 @@ class NeuronDBServer():
         prev = Neuron.from_dict(item)
         neuron = Neuron(name=neuron_name, prevNeuron=prev)
 
-        segs = set(neuron.segments)
-        blacklist_segments = set(neuron.blacklist_segments)
+        members = self._get_neuron_members(neuron_name, item, backup)
+        own_segments, own_blacklist = members.pop(neuron_name, ([], []))
+        segs = set(own_segments)
+        blacklist_segments = set(own_blacklist)
         children = []
         children_segments = set()
         segments_by_children = {}
         children_blacklist = set()
 
-        for c in self._get_children_of(neuron_name):
-            segments_by_children[c['neuron_name']] = c['segments']
-            child_segments = set([int(n) for n in c['segments']])
+        for child_name, (child_segment_list, child_blacklist) in members.items():
+            segments_by_children[child_name] = child_segment_list
+            child_segments = set(child_segment_list)
 
-            self.__update_segment_map_cache(child_segments, c['neuron_name'])
+            self.__update_segment_map_cache(child_segments, child_name)
 
             children_segments |= child_segments
-            children_blacklist |= set([int(n) for n in c['blacklist_segments']])
-            children.append(c['neuron_name'])
+            children_blacklist |= set(child_blacklist)
+            children.append(child_name)
 
         segs_without_children = segs - children_segments
         self.__update_segment_map_cache(segs_without_children, neuron.name)
@@ -196,8 +220,10 @@ class NeuronDBServer():
         neuron.segments = list(segs)
 
         if not override_assignment:
+            mappings = self._get_mapped_neurons([int(s) for s in neuron.segments])
             for s in neuron.segments:
-                mapping = self.__check_segment_belongs_to_neuron(s, neuron_name)
+                mapping = self.__check_segment_belongs_to_neuron(
+                    mappings.get(int(s)), neuron_name)
                 if mapping is not True:
                     return (False, "Fragment %s already assigned to %s" % (s, mapping))
 
@@ -234,9 +260,7 @@ class NeuronDBServer():
         # and also cache
         self.__update_segment_map_cache(segment_ids, neuron_id)
 
-    def __check_segment_belongs_to_neuron(self, segment_id, neuron_id):
-        segment_id = int(segment_id)
-        mapping = self.__get_segment_map_cached(segment_id)
+    def __check_segment_belongs_to_neuron(self, mapping, neuron_id):
         # check if (1) mapped to the same neuron, (2) unmapped, or (3) is mapped to parent
         if mapping == neuron_id or mapping is None or mapping in neuron_id:
             return True
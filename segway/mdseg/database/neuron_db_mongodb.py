@@ -4,6 +4,7 @@ from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne
 from pymongo.errors import BulkWriteError, WriteError
 
 from .neuron import Neuron
+from .segment_encoding import segment_list
 
 logger = logging.getLogger(__name__)
 
@@ -15,9 +16,13 @@ class NeuronDBServerMongoDB():
             host,
             neuron_collection='neurons',
             segment_collection='segments',
+            segment_encoding=None,
             ):
 
         self.db_name = db_name
+        # None keeps segments as id strings, readable by older versions;
+        # 'raw', 'zstd' or 'zlib' writes binary columns
+        self.segment_encoding = segment_encoding
         self.host = host
         self.counts = {}
         self.neurons_collection_name = neuron_collection
@@ -172,13 +177,13 @@ class NeuronDBServerMongoDB():
         segments_by_children = {}
         children_blacklist = set()
         for c in collection.find({'parent_segment': neuron_name}):
-            segments_by_children[c['neuron_name']] = c['segments']
-            child_segments = set([int(n) for n in c['segments']])
+            segments_by_children[c['neuron_name']] = segment_list(c['segments'])
+            child_segments = set(segments_by_children[c['neuron_name']])
 
             self.__add_segment_map(child_segments, c['neuron_name'])
 
             children_segments |= child_segments
-            children_blacklist |= set([int(n) for n in c['blacklist_segments']])
+            children_blacklist |= set(segment_list(c['blacklist_segments']))
             children.append(c['neuron_name'])
 
         segs_without_children = segs - children_segments
@@ -409,7 +414,7 @@ class NeuronDBServerMongoDB():
 
         logger.info("Saving neuron as %s" % neuron.name)
 
-        item = neuron.to_json()
+        item = neuron.to_json(self.segment_encoding)
         # print(item)
 
         try:
@@ -432,7 +437,7 @@ class NeuronDBServerMongoDB():
             self.__write(
                 self.backup_collection,
                 ['neuron_name'],
-                [neuron.to_json()],
+                [neuron.to_json(self.segment_encoding)],
                 fail_if_exists=True)
 
         except BulkWriteError as e:
@@ -1,67 +1,156 @@
 import logging
-import sqlite3
 from threading import Lock, RLock
 import pickle
 
 from .neuron_db import NeuronDBServer
 from .neuron import Neuron
+from .segment_encoding import is_encoded, decode_segments, segment_list
+from .sqlite_pool import SQLitePool
 
 logger = logging.getLogger(__name__)
 
 class NeuronDBServerSQLite(NeuronDBServer):
 
+    # stays below SQLite's default limit of 999 parameters per statement
+    max_ids_per_query = 500
+
     def __init__(
             self,
             db_url,
             neuron_collection='neurons',
             segment_collection='segments',
+            max_connections=8,
+            membership_collection='membership',
             ):
 
         self.db_url = db_url
-        self.con = None
-        self.cur = None
+        self.max_connections = max_connections
+        self.pool = None
         # keep a lock for serializing mutable operations
         self.lock = Lock()
+        # (neuron_name, segment_id, blacklisted) rows of all neurons, the
+        # source of segment lists and of the segment to neuron mapping
+        self.membership_collection = membership_collection
 
         NeuronDBServer.__init__(self, db_url, neuron_collection, segment_collection)
+        self._create_membership()
         # todo: add backup collection
 
+    def _create_membership(self):
+        '''Creates the membership table and the triggers that keep it in
+        sync with the neuron records, also for records written by other
+        programs: every inserted, updated or deleted record marks its
+        neuron as stale, and stale neurons are reindexed before the table
+        is queried'''
+        membership = self.membership_collection
+        with self.pool.write() as con:
+            # keeps other processes from creating the table concurrently
+            con.execute('BEGIN IMMEDIATE')
+            has_triggers = con.execute(
+                "SELECT COUNT(1) FROM sqlite_master WHERE type='trigger' AND name=?",
+                [f'{membership}_update']).fetchone()[0]
+            con.execute(f'CREATE TABLE IF NOT EXISTS {membership} ('
+                        'neuron_name TEXT NOT NULL, segment_id INTEGER NOT NULL, '
+                        'blacklisted INTEGER NOT NULL, '
+                        'PRIMARY KEY (neuron_name, blacklisted, segment_id))')
+            con.execute(f'CREATE INDEX IF NOT EXISTS {membership}_segment_id '
+                        f'on {membership} (segment_id)')
+            con.execute(f'CREATE TABLE IF NOT EXISTS {membership}_stale '
+                        '(neuron_name TEXT PRIMARY KEY)')
+            if has_triggers:
+                return
+
+            stale = f'INSERT OR IGNORE INTO {membership}_stale VALUES'
+            con.execute(f'CREATE TRIGGER {membership}_insert AFTER INSERT ON {self.neuron_collection} '
+                        f'BEGIN {stale} (NEW.neuron_name); END')
+            con.execute(f'CREATE TRIGGER {membership}_update AFTER UPDATE ON {self.neuron_collection} '
+                        f'BEGIN {stale} (OLD.neuron_name), (NEW.neuron_name); END')
+            con.execute(f'CREATE TRIGGER {membership}_delete AFTER DELETE ON {self.neuron_collection} '
+                        f'BEGIN {stale} (OLD.neuron_name); END')
+            # (re)index all records written while there were no triggers
+            con.execute(f'DELETE FROM {membership}')
+            con.execute(f'INSERT OR IGNORE INTO {membership}_stale '
+                        f'SELECT neuron_name FROM {self.neuron_collection}')
+        self._update_membership()
+
+    def _update_membership(self):
+        '''Reindexes the segments of the neurons marked as stale'''
+        membership = self.membership_collection
+        with self.pool.read() as con:
+            if con.execute(f'SELECT 1 FROM {membership}_stale LIMIT 1').fetchone() is None:
+                return
+
+        with self.pool.write() as con:
+            # no record can change between reading the stale neurons and
+            # reindexing them
+            con.execute('BEGIN IMMEDIATE')
+            names = [r[0] for r in con.execute(f'SELECT neuron_name FROM {membership}_stale')]
+            num_rows = 0
+            for i in range(0, len(names), self.max_ids_per_query):
+                chunk = names[i:i+self.max_ids_per_query]
+                placeholders = ', '.join(['?'] * len(chunk))
+                con.execute(f"DELETE FROM {membership} WHERE neuron_name IN ({placeholders})", chunk)
+                rows = con.execute(f"SELECT neuron_name, segments, blacklist_segments "
+                                   f"FROM {self.neuron_collection} "
+                                   f"WHERE neuron_name IN ({placeholders})", chunk)
+                for row in rows.fetchall():
+                    entry = self.__unpack_entry(row)
+                    items = self.__membership_items(
+                        entry['neuron_name'],
+                        segment_list([] if entry['segments'] is None else entry['segments']),
+                        segment_list([] if entry['blacklist_segments'] is None
+                                     else entry['blacklist_segments']))
+                    con.executemany(f"INSERT OR IGNORE INTO {membership} VALUES (?, ?, ?)", items)
+                    num_rows += len(items)
+                con.execute(f"DELETE FROM {membership}_stale WHERE neuron_name IN ({placeholders})", chunk)
+            logger.info("Reindexed %d neurons with %d segments in %s" % (
+                len(names), num_rows, membership))
+
+    @staticmethod
+    def __membership_items(neuron_name, segment_ids, blacklist_segment_ids):
+        return [(neuron_name, sid, 0) for sid in segment_ids] + \
+               [(neuron_name, sid, 1) for sid in blacklist_segment_ids]
+
     def _create_index(self, index_list, unique):
-        for k in index_list:
-            if k in unique:
-                self.cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {k} on {self.neuron_collection} ({k})')
-            else:
-                self.cur.execute(f'CREATE INDEX IF NOT EXISTS {k} on {self.neuron_collection} ({k})')
+        with self.pool.write() as con:
+            for k in index_list:
+                if k in unique:
+                    con.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {k} on {self.neuron_collection} ({k})')
+                else:
+                    con.execute(f'CREATE INDEX IF NOT EXISTS {k} on {self.neuron_collection} ({k})')
 
     def _connect(self):
-        self.con = sqlite3.connect(self.db_url, check_same_thread=False)
-        self.con.row_factory = sqlite3.Row
-        self.cur = self.con.cursor()
+        self.pool = SQLitePool(
+            self.db_url, max_connections=self.max_connections, write_lock=self.lock)
 
     def _check_collections(self, collections):
-        res = self.cur.execute("SELECT name FROM sqlite_master").fetchall()
+        with self.pool.read() as con:
+            res = con.execute("SELECT name FROM sqlite_master").fetchall()
         res = [k['name'] for k in res]
         for c in collections:
             assert c in res, f"Collection {c} not found in db"
 
     def _close(self):
-        self.con.close()
+        self.pool.close()
 
     def _get_neuron(self, neuron_name, backup=False):
         collection = self.backup_collection if backup else self.neuron_collection
-        res = self.cur.execute(f"SELECT * FROM {collection} WHERE neuron_name=?", [neuron_name]).fetchone()
+        with self.pool.read() as con:
+            res = con.execute(f"SELECT * FROM {collection} WHERE neuron_name=?", [neuron_name]).fetchone()
         if res is None:
             return None
         return self.__unpack_entry(res)
 
     def _exists_neuron(self, neuron_name, backup=False):
         collection = self.backup_collection if backup else self.neuron_collection
-        res = self.cur.execute(f"SELECT COUNT(1) FROM {collection} WHERE neuron_name=?", [neuron_name]).fetchone()
+        with self.pool.read() as con:
+            res = con.execute(f"SELECT COUNT(1) FROM {collection} WHERE neuron_name=?", [neuron_name]).fetchone()
         return res['COUNT(1)'] == 1
 
     def _get_children_of(self, neuron_name, backup=False):
         collection = self.backup_collection if backup else self.neuron_collection
-        res = self.cur.execute(f"SELECT * FROM {collection} WHERE parent_segment=?", [neuron_name])
+        with self.pool.read() as con:
+            res = con.execute(f"SELECT * FROM {collection} WHERE parent_segment=?", [neuron_name]).fetchall()
         ret = []
         for item in res:
             ret.append(__class__.__unpack_entry(item))
@@ -72,6 +161,8 @@ class NeuronDBServerSQLite(NeuronDBServer):
         if type(data) in [int, bool, str]:
             return data
         elif type(data) == bytes:
+            if is_encoded(data):
+                return decode_segments(data)
             return pickle.loads(data)
         raise RuntimeError(f'Unhandled unpacking {data} of type {type(data)}')
 
@@ -90,32 +181,77 @@ class NeuronDBServerSQLite(NeuronDBServer):
             for k, v in query.items():
                 command += ' {k}=?'
                 query_data.append(v)
-        res = self.cur.execute(command, query_data)
-        ret = [v[0] for v in res.fetchall()]
+        with self.pool.read() as con:
+            res = con.execute(command, query_data).fetchall()
+        ret = [v[0] for v in res]
         return ret
 
+    def _get_neuron_members(self, neuron_name, item, backup=False):
+        if backup:
+            # backups have no membership rows
+            return super()._get_neuron_members(neuron_name, item, backup)
+        self._update_membership()
+        members = {}
+        with self.pool.read() as con:
+            # children without segments have no membership rows but are
+            # still returned, with empty segment lists
+            rows = con.execute(
+                f"SELECT n.neuron_name, m.segment_id, m.blacklisted "
+                f"FROM {self.neuron_collection} AS n "
+                f"LEFT JOIN {self.membership_collection} AS m ON m.neuron_name=n.neuron_name "
+                f"WHERE n.neuron_name=? OR n.parent_segment=?",
+                [neuron_name, neuron_name]).fetchall()
+        for name, sid, blacklisted in rows:
+            if name not in members:
+                members[name] = ([], [])
+            if sid is not None:
+                members[name][blacklisted].append(sid)
+        if neuron_name not in members:
+            # e.g. a neuron without segments
+            members[neuron_name] = (
+                segment_list([] if item.get('segments') is None else item['segments']),
+                segment_list([] if item.get('blacklist_segments') is None
+                             else item['blacklist_segments']))
+        return members
+
+    def _get_mapped_neurons(self, segment_ids):
+        self._update_membership()
+        mappings = {}
+        segment_ids = list(set(segment_ids))
+        with self.pool.read() as con:
+            for i in range(0, len(segment_ids), self.max_ids_per_query):
+                chunk = segment_ids[i:i+self.max_ids_per_query]
+                # a segment in both a parent and a child maps to the child,
+                # whose name extends the parent's, as get_neuron maps it
+                rows = con.execute(
+                    f"SELECT segment_id, neuron_name FROM {self.membership_collection} "
+                    f"WHERE segment_id IN ({', '.join(['?'] * len(chunk))}) "
+                    f"AND blacklisted=0 ORDER BY LENGTH(neuron_name)", chunk)
+                for sid, name in rows.fetchall():
+                    mappings[sid] = name
+        return mappings
+
     def _get_mapped_neuron(self, segment_id):
-        item = self.cur.execute(f"SELECT * FROM {self.segment_collection} "
-                                 "WHERE segment_id=?", [segment_id]).fetchone()
-        return item['neuron_name'] if item else None
+        return self._get_mapped_neurons([int(segment_id)]).get(int(segment_id))
 
     def _modify_segment_map(self, segment_ids, neuron_id):
         # todo: write more succicntly
         items = []
         for sid in segment_ids:
-            items.append((sid,))
-            # items.append((neuron_id, sid))
+            items.append((sid, neuron_id))
         if len(items):
             # self.cur.executemany(f"UPDATE {self.segment_collection}"
             #                      f"SET neuron_name = {neuron_id}"
             #                       "WHERE segment_id = ?", items)
-            self.cur.executemany(
-                f"INSERT INTO {self.segment_collection}(segment_id, neuron_name) "
-                f"VALUES (?, {neuron_id}) "
-                f"ON CONFLICT(segment_id) DO UPDATE SET neuron_name={neuron_id}", items
-                )
+            with self.pool.write() as con:
+                con.executemany(
+                    f"INSERT INTO {self.segment_collection}(segment_id, neuron_name) "
+                    f"VALUES (?, ?) "
+                    f"ON CONFLICT(segment_id) DO UPDATE SET neuron_name=excluded.neuron_name", items
+                    )
 
     def _count_prefix_in_db(prefix):
-        res = self.cur.execute(f"SELECT COUNT(*) FROM {self.neuron_collection} "
-                                 "WHERE name_prefix=?", [prefix])
+        with self.pool.read() as con:
+            res = con.execute(f"SELECT COUNT(*) FROM {self.neuron_collection} "
+                               "WHERE name_prefix=?", [prefix]).fetchone()[0]
         return res
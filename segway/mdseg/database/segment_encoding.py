@@ -0,0 +1,218 @@
+'''Binary encoding of the `segments` and `blacklist_segments` columns of
+neuron records.
+
+An encoded column is an 8-byte header followed by the segment ids:
+
+    bytes 0-3  magic ``MDSG``
+    byte  4    format version (currently 1)
+    byte  5    codec: 0 raw, 1 delta+zstd, 2 delta+zlib
+    bytes 6-7  reserved
+
+Raw payloads are little-endian uint64 ids and decode zero-copy with
+`np.frombuffer`. The delta codecs store the differences between
+consecutive ids (wrapping, so any order round-trips), compressed with zstd
+(requires the `zstandard` package) or zlib.
+
+Records written before this encoding hold lists of ids or of id strings;
+`decode_segments` accepts those too. Existing databases are rewritten with
+
+    python -m segway.mdseg.database.segment_encoding sqlite neurons.db
+    python -m segway.mdseg.database.segment_encoding mongodb db_name host
+'''
+import argparse
+import pickle
+import sqlite3
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MDSG'
+VERSION = 1
+HEADER = struct.Struct('<4sBBxx')
+
+CODECS = {
+    None: 0,
+    'zstd': 1,
+    'zlib': 2,
+}
+
+SEGMENT_COLUMNS = ['segments', 'blacklist_segments']
+
+
+def is_encoded(data):
+    return isinstance(data, (bytes, bytearray, memoryview)) and \
+        bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def encode_segments(segments, compression=None):
+    '''Returns the ids in `segments` (ints or strings) as an encoded
+    column, compressed with 'zstd', 'zlib' or not at all'''
+    if compression not in CODECS:
+        raise ValueError(f'Unknown segment compression {compression}')
+    if isinstance(segments, np.ndarray):
+        ids = segments.astype('<u8')
+    else:
+        ids = np.fromiter((int(k) for k in segments), dtype='<u8', count=len(segments))
+    header = HEADER.pack(MAGIC, VERSION, CODECS[compression])
+    if compression is None:
+        return header + ids.tobytes()
+
+    deltas = ids.copy()
+    deltas[1:] -= ids[:-1]
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        payload = zstandard.ZstdCompressor().compress(deltas.tobytes())
+    else:
+        payload = zlib.compress(deltas.tobytes())
+    return header + payload
+
+
+def decode_segments(data):
+    '''Returns the segment ids of an encoded column (or of a list of ids)
+    as a uint64 array, read-only and without copying for raw columns'''
+    if not is_encoded(data):
+        return np.array([int(k) for k in data], dtype=np.uint64)
+
+    _, version, codec = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise RuntimeError(f'Unsupported segment encoding version {version}')
+    if codec == CODECS[None]:
+        return np.frombuffer(data, dtype='<u8', offset=HEADER.size)
+
+    payload = bytes(data[HEADER.size:])
+    if codec == CODECS['zstd']:
+        if zstandard is None:
+            raise RuntimeError("Decoding zstd segments requires the zstandard package")
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif codec == CODECS['zlib']:
+        payload = zlib.decompress(payload)
+    else:
+        raise RuntimeError(f'Unknown segment codec {codec}')
+    return np.cumsum(np.frombuffer(payload, dtype='<u8'), dtype=np.uint64)
+
+
+def segment_list(data):
+    '''Returns the ids of an encoded column or a list of ids as ints'''
+    if isinstance(data, np.ndarray):
+        return data.tolist()
+    return decode_segments(data).tolist()
+
+
+def _reencode(value, compression):
+    if is_encoded(value):
+        _, _, codec = HEADER.unpack_from(value)
+        if codec == CODECS[compression]:
+            return None
+        value = decode_segments(value)
+    return encode_segments(value, compression)
+
+
+def migrate_sqlite(db_file, collections=('neurons', 'neurons_bak'),
+                   compression=None, batch_size=1000):
+    '''Rewrites the segment columns of `collections` in place. Returns the
+    number of rewritten rows.'''
+    con = sqlite3.connect(db_file)
+    tables = [r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    num_rows = 0
+    try:
+        for collection in collections:
+            if collection not in tables:
+                logger.info("Skipping missing table %s" % collection)
+                continue
+            columns = [r[1] for r in con.execute(f'PRAGMA table_info({collection})')]
+            columns = [c for c in SEGMENT_COLUMNS if c in columns]
+            if not columns:
+                continue
+            rows = con.execute(
+                f"SELECT rowid, {', '.join(columns)} FROM {collection}").fetchall()
+            updates = []
+            for rowid, *values in rows:
+                encoded = []
+                for value in values:
+                    if value is None:
+                        encoded.append(None)
+                        continue
+                    if not is_encoded(value) and type(value) is bytes:
+                        value = pickle.loads(value)
+                    encoded.append(_reencode(value, compression))
+                if any(e is not None for e in encoded):
+                    updates.append(tuple(
+                        e if e is not None else v for e, v in zip(encoded, values))
+                        + (rowid,))
+            assignments = ', '.join(f'{c}=?' for c in columns)
+            with con:
+                for i in range(0, len(updates), batch_size):
+                    con.executemany(
+                        f"UPDATE {collection} SET {assignments} WHERE rowid=?",
+                        updates[i:i+batch_size])
+            logger.info("Rewrote %d of %d rows of %s" % (len(updates), len(rows), collection))
+            num_rows += len(updates)
+    finally:
+        con.close()
+    return num_rows
+
+
+def migrate_mongodb(db_name, host, collections=('neurons', 'neurons_bak'),
+                    compression=None, batch_size=1000):
+    '''Rewrites the segment fields of `collections` in place. Returns the
+    number of rewritten documents.'''
+    from pymongo import MongoClient, UpdateOne
+
+    client = MongoClient(host)
+    num_docs = 0
+    try:
+        database = client[db_name]
+        for collection_name in collections:
+            collection = database[collection_name]
+            projection = {c: True for c in SEGMENT_COLUMNS}
+            updates = []
+            for doc in collection.find({}, projection):
+                fields = {}
+                for c in SEGMENT_COLUMNS:
+                    if doc.get(c) is not None:
+                        encoded = _reencode(doc[c], compression)
+                        if encoded is not None:
+                            fields[c] = encoded
+                if fields:
+                    updates.append(UpdateOne({'_id': doc['_id']}, {'$set': fields}))
+                if len(updates) >= batch_size:
+                    collection.bulk_write(updates)
+                    num_docs += len(updates)
+                    updates = []
+            if updates:
+                collection.bulk_write(updates)
+                num_docs += len(updates)
+            logger.info("Rewrote documents of %s" % collection_name)
+    finally:
+        client.close()
+    return num_docs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='python -m segway.mdseg.database.segment_encoding')
+    parser.add_argument('backend', choices=['sqlite', 'mongodb'])
+    parser.add_argument('db', help="SQLite file or MongoDB database name")
+    parser.add_argument('host', nargs='?', help="MongoDB host")
+    parser.add_argument('--collections', nargs='+', default=['neurons', 'neurons_bak'])
+    parser.add_argument('--compression', default=None, choices=['zstd', 'zlib'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.backend == 'sqlite':
+        n = migrate_sqlite(args.db, args.collections, args.compression)
+    else:
+        if args.host is None:
+            parser.error("MongoDB needs a host")
+        n = migrate_mongodb(args.db, args.host, args.collections, args.compression)
+    print("Rewrote %d records" % n)
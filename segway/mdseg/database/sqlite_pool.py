@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SQLitePool():
+    '''A bounded pool of SQLite connections in WAL mode.
+
+    Each thread checks out its own connection for the duration of a `read()`
+    or `write()` block (nested blocks reuse it), so reads of different
+    threads run in parallel. Writes additionally hold `write_lock`, which
+    serializes the writers of this process. At most `max_connections`
+    connections are open; further threads wait for one to be returned.
+
+    In-memory databases are not supported, as every connection would open
+    its own database.
+    '''
+
+    def __init__(self, db_file, max_connections=8, timeout=60,
+                 synchronous='NORMAL', cache_size_mib=64, write_lock=None):
+        self.db_file = db_file
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.cache_size_mib = cache_size_mib
+        self.write_lock = write_lock or threading.Lock()
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        self.idle = []
+        self.num_connections = 0
+        self.closed = False
+
+    def _open(self):
+        # connections move between threads, but only one uses them at a time
+        con = sqlite3.connect(
+            self.db_file, timeout=self.timeout, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        # WAL lets readers proceed during writes, and with it
+        # synchronous=NORMAL is still safe against corruption
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute(f'PRAGMA synchronous={self.synchronous}')
+        con.execute(f'PRAGMA cache_size=-{self.cache_size_mib*1024}')
+        return con
+
+    def _checkout(self):
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise RuntimeError(f'Connection pool of {self.db_file} is closed')
+                if self.idle:
+                    return self.idle.pop()
+                if self.num_connections < self.max_connections:
+                    self.num_connections += 1
+                    break
+                if not self.condition.wait(self.timeout):
+                    raise TimeoutError(
+                        f'No connection to {self.db_file} available '
+                        f'after {self.timeout}s')
+        try:
+            return self._open()
+        except BaseException:
+            with self.condition:
+                self.num_connections -= 1
+                self.condition.notify()
+            raise
+
+    def _return(self, con):
+        with self.condition:
+            if self.closed:
+                con.close()
+                self.num_connections -= 1
+            else:
+                self.idle.append(con)
+            self.condition.notify()
+
+    @contextmanager
+    def read(self):
+        '''Yields the connection of the calling thread'''
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            yield con
+            return
+        con = self.local.con = self._checkout()
+        try:
+            yield con
+        finally:
+            self.local.con = None
+            self._return(con)
+
+    @contextmanager
+    def write(self):
+        '''Yields the connection of the calling thread within a transaction,
+        committed at the end of the block or rolled back on an exception'''
+        # the connection is taken before the lock, so that a writer never
+        # waits for a connection held by a thread waiting for the lock
+        with self.read() as con:
+            with self.write_lock:
+                with con:
+                    yield con
+
+    def close(self):
+        '''Closes all connections; connections in use are closed when they
+        are returned'''
+        with self.condition:
+            self.closed = True
+            for con in self.idle:
+                con.close()
+            self.num_connections -= len(self.idle)
+            self.idle = []
+            self.condition.notify_all()
@@ -0,0 +1,163 @@
+'''Hot-path timing instrumentation for the connected segment servers.
+
+Servers time their stages (e.g. ``decode``, ``cache_probe``, ``load``,
+``scan``, ``merge``) with ``with self.instrumentation.timer(stage):`` and
+count events with ``self.instrumentation.count(name, n)``. By default they
+hold a `NullInstrumentation`, whose timer is a shared no-op context
+manager, so instrumentation can stay in place in production.
+'''
+import logging
+import math
+import time
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class _NullTimer():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullInstrumentation():
+    '''Records nothing'''
+
+    enabled = False
+
+    def timer(self, stage):
+        return _NULL_TIMER
+
+    def record_time(self, stage, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class _Timer():
+
+    __slots__ = ('instrumentation', 'stage', 'start')
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.instrumentation.record_time(
+            self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Instrumentation():
+    '''Aggregates per-stage timings and counters, and forwards every
+    measurement to the given sinks.
+
+    A sink implements ``record_time(stage, seconds)`` and
+    ``record_count(name, n)``, see `LoggingSink`, `CallbackSink` and
+    `HistogramSink`.
+    '''
+
+    enabled = True
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks) if sinks else []
+        self.lock = Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def record_time(self, stage, seconds):
+        with self.lock:
+            n, total, worst = self.timings.get(stage, (0, 0., 0.))
+            self.timings[stage] = (n + 1, total + seconds, max(worst, seconds))
+        for sink in self.sinks:
+            sink.record_time(stage, seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        for sink in self.sinks:
+            sink.record_count(name, n)
+
+    def stats(self):
+        '''Returns {'timings': {stage: {calls, total, max}}, 'counters': ...}'''
+        with self.lock:
+            timings = {
+                stage: {'calls': n, 'total': total, 'max': worst}
+                for stage, (n, total, worst) in self.timings.items()}
+            return {'timings': timings, 'counters': dict(self.counters)}
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+
+class LoggingSink():
+
+    def __init__(self, log=logger, level=logging.DEBUG):
+        self.log = log
+        self.level = level
+
+    def record_time(self, stage, seconds):
+        self.log.log(self.level, "%s took %.3fms" % (stage, seconds*1000))
+
+    def record_count(self, name, n):
+        self.log.log(self.level, "%s += %d" % (name, n))
+
+
+class CallbackSink():
+    '''Calls ``callback(kind, name, value)`` with kind 'time' or 'count'.'''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record_time(self, stage, seconds):
+        self.callback('time', stage, seconds)
+
+    def record_count(self, name, n):
+        self.callback('count', name, n)
+
+
+class HistogramSink():
+    '''In-memory latency histograms with power-of-two microsecond buckets'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+
+    def record_time(self, stage, seconds):
+        bucket = max(0, math.ceil(math.log2(max(seconds * 1e6, 1))))
+        with self.lock:
+            histogram = self.histograms.setdefault(stage, {})
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def record_count(self, name, n):
+        pass
+
+    def dump(self):
+        '''Returns the histograms as text, one line per non-empty bucket'''
+        lines = []
+        with self.lock:
+            for stage in sorted(self.histograms):
+                lines.append(stage)
+                histogram = self.histograms[stage]
+                for bucket in sorted(histogram):
+                    lines.append("  <= %10dus: %d" % (2**bucket, histogram[bucket]))
+        return '\n'.join(lines)
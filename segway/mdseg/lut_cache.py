@@ -0,0 +1,108 @@
+import sys
+from threading import Lock
+
+from cachetools import LRUCache
+
+
+def _sizeof(value):
+    '''Size of a cached LUT block in bytes'''
+    nbytes = getattr(value, 'nbytes', None)
+    if nbytes is None:
+        return sys.getsizeof(value)
+    return nbytes
+
+
+class _CountingLRUCache(LRUCache):
+
+    def __init__(self, maxsize, getsizeof=None, on_evict=None):
+        super().__init__(maxsize, getsizeof=getsizeof)
+        self.evictions = 0
+        self.on_evict = on_evict
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(*item)
+        return item
+
+
+class LUTCache():
+    '''Byte-budgeted LRU cache of decoded LUT blocks (e.g. adjacency and
+    component indexes), owned by a single segment server.
+
+    Entries are sized by their `nbytes`; a block larger than the whole
+    budget is returned to the caller but not cached. `on_evict(key, value)`
+    is called for every entry dropped from the cache.
+    '''
+
+    def __init__(self, cache_bytes=4*1024*1024*1024, on_evict=None):
+        self.cache_bytes = cache_bytes
+        self.on_evict = on_evict
+        self.cache = _CountingLRUCache(
+            maxsize=cache_bytes, getsizeof=_sizeof, on_evict=on_evict)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.cache
+
+    def get(self, key):
+        with self.lock:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value, evict=True):
+        '''Caches `value`. With `evict=False` the value is only cached if it
+        fits without evicting other entries.'''
+        with self.lock:
+            size = self.cache.getsizeof(value)
+            cached = size <= self.cache.maxsize
+            if not evict and self.cache.currsize + size > self.cache.maxsize:
+                cached = False
+            if cached and self.on_evict is not None and key in self.cache:
+                # keep the entry another thread loaded concurrently
+                cached = False
+            if cached:
+                self.cache[key] = value
+        if not cached and self.on_evict is not None:
+            self.on_evict(key, value)
+
+    @property
+    def currsize(self):
+        return self.cache.currsize
+
+    def get_or_load(self, key, load_fn, *args):
+        value = self.get(key)
+        if value is None:
+            # loading is done outside of the lock so that other lookups are
+            # not blocked on file I/O
+            value = load_fn(*args)
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            items = list(self.cache.items())
+            for key, _ in items:
+                del self.cache[key]
+        if self.on_evict is not None:
+            for key, value in items:
+                self.on_evict(key, value)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.cache.evictions,
+                'entries': len(self.cache),
+                'bytes': self.cache.currsize,
+                'cache_bytes': self.cache.maxsize,
+            }
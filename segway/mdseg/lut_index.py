@@ -0,0 +1,239 @@
+'''In-memory indexes built once per loaded hierarchy LUT block.'''
+import numpy as np
+
+
+def concat_ranges(starts, lengths):
+    '''Returns the concatenation of ``arange(start, start+length)`` for all
+    given ranges without a Python loop'''
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    total = ends[-1] if len(ends) else 0
+    return np.repeat(starts - (ends - lengths), lengths) + np.arange(total)
+
+
+class ComponentIndex():
+    '''Inverted index from fragment id to the connected component of a
+    ``threshold_map`` block that contains it.
+
+    Components are kept in their flattened (fragments, offsets) form; the
+    fragment ids are additionally sorted so that a lookup is a binary
+    search instead of a scan over every component of the block. A
+    precomputed lookup table (`sorted_fragments`, `sorted_labels`) can be
+    given instead, e.g. memory-mapped global labels covering the dataset.
+    '''
+
+    def __init__(self, fragments, offsets, sorted_fragments=None, sorted_labels=None):
+        fragments = np.asarray(fragments)
+        offsets = np.asarray(offsets)
+        if sorted_fragments is None:
+            labels = np.repeat(
+                np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+            # a stable sort keeps the first component listing a fragment
+            # first, matching the previous linear scan
+            order = np.argsort(fragments, kind='stable')
+            sorted_fragments = fragments[order]
+            sorted_labels = labels[order]
+        self.fragments = fragments
+        self.offsets = offsets
+        self.sorted_fragments = sorted_fragments
+        self.sorted_labels = sorted_labels
+
+    @property
+    def nbytes(self):
+        return (self.fragments.nbytes + self.offsets.nbytes
+                + self.sorted_fragments.nbytes + self.sorted_labels.nbytes)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def arrays(self):
+        '''Returns the index arrays, e.g. to share them; ``ComponentIndex(
+        **index.arrays())`` restores the index without recomputation'''
+        return {
+            'fragments': self.fragments,
+            'offsets': self.offsets,
+            'sorted_fragments': self.sorted_fragments,
+            'sorted_labels': self.sorted_labels,
+        }
+
+    def find_components(self, fragment_ids):
+        '''Returns the component label of each fragment id, or -1 if the
+        fragment is not part of any component'''
+        fragment_ids = np.asarray(fragment_ids, dtype=self.fragments.dtype)
+        if len(self.sorted_fragments) == 0:
+            return np.full(len(fragment_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.sorted_fragments, fragment_ids)
+        pos[pos == len(self.sorted_fragments)] = 0
+        found = self.sorted_fragments[pos] == fragment_ids
+        return np.where(found, self.sorted_labels[pos], -1)
+
+    def find_component(self, fragment_id):
+        return int(self.find_components([fragment_id])[0])
+
+    def get_component(self, label):
+        return self.fragments[self.offsets[label]:self.offsets[label+1]]
+
+    def get_components(self, labels):
+        '''Returns the concatenated members of the given components'''
+        labels = np.asarray(labels, dtype=np.int64)
+        starts = self.offsets[labels]
+        return self.fragments[
+            concat_ranges(starts, self.offsets[labels + 1] - starts)]
+
+
+def _as_edge_array(edges):
+    edges = np.asarray(edges)
+    if edges.size == 0:
+        return edges.reshape(0, 2)
+    return edges
+
+
+def find_neighbors(edges, node):
+    '''Returns the neighbors of `node` in an (n, 2) edge list with a single
+    vectorized pass, for edge lists that are only queried once'''
+    edges = _as_edge_array(edges)
+    node = np.asarray(node, dtype=edges.dtype)
+    return np.concatenate([
+        edges[edges[:, 0] == node, 1],
+        edges[edges[:, 1] == node, 0]])
+
+
+class AdjacencyIndex():
+    '''Undirected adjacency of one edge list in CSR form.
+
+    `nodes` holds the sorted unique node ids and the neighbors of
+    ``nodes[i]`` are ``indices[indptr[i]:indptr[i+1]]``, so a neighbor query
+    is a ``searchsorted`` plus a slice. With per-edge merge `scores`, queries
+    can be restricted to the edges with ``score <= max_score``.
+    '''
+
+    def __init__(self, edges, scores=None):
+        edges = _as_edge_array(edges)
+        src = np.concatenate([edges[:, 0], edges[:, 1]])
+        dst = np.concatenate([edges[:, 1], edges[:, 0]])
+        order = np.argsort(src, kind='stable')
+        src = src[order]
+        self.indices = dst[order]
+        self.scores = None
+        if scores is not None:
+            scores = np.asarray(scores)
+            self.scores = np.concatenate([scores, scores])[order]
+        self.nodes, counts = np.unique(src, return_counts=True)
+        self.indptr = np.zeros(len(self.nodes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+    @property
+    def nbytes(self):
+        nbytes = self.nodes.nbytes + self.indptr.nbytes + self.indices.nbytes
+        if self.scores is not None:
+            nbytes += self.scores.nbytes
+        return nbytes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @classmethod
+    def from_arrays(cls, nodes, indptr, indices, scores=None):
+        '''Restores an index from the arrays returned by `arrays`'''
+        index = cls.__new__(cls)
+        index.nodes = nodes
+        index.indptr = indptr
+        index.indices = indices
+        index.scores = scores
+        return index
+
+    def arrays(self):
+        arrays = {'nodes': self.nodes, 'indptr': self.indptr, 'indices': self.indices}
+        if self.scores is not None:
+            arrays['scores'] = self.scores
+        return arrays
+
+    def find_nodes(self, node_ids):
+        '''Returns the position of each node id in `nodes`, or -1 if the node
+        has no edges'''
+        node_ids = np.asarray(node_ids, dtype=self.nodes.dtype)
+        if len(self.nodes) == 0:
+            return np.full(len(node_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self.nodes, node_ids)
+        pos[pos == len(self.nodes)] = 0
+        return np.where(self.nodes[pos] == node_ids, pos, -1)
+
+    def neighbors_many(self, node_ids, max_score=None):
+        '''Returns (sources, neighbors): all neighbors of the given nodes,
+        each paired with the queried node it is adjacent to'''
+        node_ids = np.asarray(node_ids, dtype=self.nodes.dtype)
+        pos = self.find_nodes(node_ids)
+        found = pos >= 0
+        pos = pos[found]
+        starts = self.indptr[pos]
+        counts = self.indptr[pos + 1] - starts
+        sources = np.repeat(node_ids[found], counts)
+        edge_pos = concat_ranges(starts, counts)
+        if max_score is not None:
+            within = self.scores[edge_pos] <= max_score
+            sources = sources[within]
+            edge_pos = edge_pos[within]
+        return sources, self.indices[edge_pos]
+
+    def neighbors(self, node_id, max_score=None):
+        i = self.find_nodes([node_id])[0]
+        if i < 0:
+            return self.indices[:0]
+        neighbors = self.indices[self.indptr[i]:self.indptr[i+1]]
+        if max_score is not None:
+            neighbors = neighbors[
+                self.scores[self.indptr[i]:self.indptr[i+1]] <= max_score]
+        return neighbors
+
+    def edges(self, max_score=None):
+        '''Returns the (n, 2) array of all edges, each in both directions'''
+        sources = np.repeat(self.nodes, np.diff(self.indptr))
+        edges = np.stack([sources, self.indices], axis=1)
+        if max_score is not None:
+            edges = edges[self.scores <= max_score]
+        return edges
+
+
+def _find_roots(parents, nodes):
+    roots = nodes
+    while True:
+        next_roots = parents[roots]
+        if (next_roots == roots).all():
+            return roots
+        roots = next_roots
+
+
+def connected_component_labels(num_nodes, edges):
+    '''Labels each of `num_nodes` nodes with the smallest node of its
+    connected component under the (n, 2) node index array `edges`'''
+    parents = np.arange(num_nodes, dtype=np.int64)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    while len(edges):
+        # hook the larger root onto the smaller one until all edges are
+        # within a single tree
+        roots_u = _find_roots(parents, edges[:, 0])
+        roots_v = _find_roots(parents, edges[:, 1])
+        keep = roots_u != roots_v
+        roots_u = roots_u[keep]
+        roots_v = roots_v[keep]
+        edges = edges[keep]
+        np.minimum.at(parents, np.maximum(roots_u, roots_v),
+                      np.minimum(roots_u, roots_v))
+    return _find_roots(parents, np.arange(num_nodes, dtype=np.int64))
+
+
+def component_index_from_edges(edges):
+    '''Returns the `ComponentIndex` of the connected components of an edge
+    list, leaving out single fragments'''
+    edges = _as_edge_array(edges)
+    nodes, inverse = np.unique(edges, return_inverse=True)
+    labels = connected_component_labels(len(nodes), inverse.reshape(-1, 2))
+    order = np.argsort(labels, kind='stable')
+    _, starts, counts = np.unique(
+        labels[order], return_index=True, return_counts=True)
+    keep = counts > 1
+    members = nodes[order[concat_ranges(starts[keep], counts[keep])]]
+    offsets = np.zeros(keep.sum() + 1, dtype=np.int64)
+    np.cumsum(counts[keep], out=offsets[1:])
+    return ComponentIndex(members, offsets)
@@ -0,0 +1,413 @@
+'''Readers and converters for the per-super-block hierarchy LUT files.
+
+Three on-disk layouts are supported:
+
+    npz: one compressed ``<block_id>.npz`` per super block, as written by
+         the segmentation pipeline.
+    npy: uncompressed ``<block_id>.<array>.npy`` files that are opened with
+         ``np.load(mmap_mode='r')``, so that a lookup only touches the pages
+         it needs and processes share the OS page cache.
+    sharded: all blocks of a LUT directory packed into a few large
+         ``shards/shard_XXXX.bin`` files plus an ``shards/index.npy`` table
+         of (block_id, array name) -> (shard, offset, length). Each entry
+         is a serialized .npy array that is memory-mapped in place, so a
+         block costs a seek instead of a file open.
+
+Connected components (``threshold_map``) are ragged. In the npy and sharded
+layouts they are stored flattened as ``fragments`` plus component
+``offsets``, such that component `i` is
+``fragments[offsets[i]:offsets[i+1]]``.
+
+The npy and sharded layouts also store the lookup indexes built from these
+arrays, i.e. the CSR arrays of the `AdjacencyIndex` of the edges
+(``csr_nodes``, ``csr_indptr``, ``csr_indices`` and ``csr_scores``) and the
+sorted lookup table of the `ComponentIndex` (``sorted_fragments``,
+``sorted_labels``). `read_adjacency` and `read_component_index` map them in
+place instead of building the index on the heap, and fall back to building
+it for blocks converted without them.
+
+Besides the per-threshold ``edges_super2super`` directories, the edges of all
+thresholds can be stored once in ``edges_super2super_scored`` next to the
+``threshold_map_XX`` directories, with the merge score of each edge (the
+lowest threshold it appears at), see `build_scored_edges`.
+'''
+import glob
+import io
+import os
+import sys
+
+import numpy as np
+
+from .lut_index import AdjacencyIndex, ComponentIndex
+
+LUT_FORMATS = ['npz', 'npy', 'sharded']
+
+SCORED_EDGES_DIR = 'edges_super2super_scored'
+
+ADJACENCY_ARRAYS = ['nodes', 'indptr', 'indices']
+
+SHARD_INDEX_DTYPE = np.dtype([
+    ('block_id', np.int64),
+    ('name', 'S16'),
+    ('shard', np.int32),
+    ('offset', np.int64),
+    ('length', np.int64),
+])
+
+
+def flatten_components(components):
+    '''Flattens a ragged list of components into (fragments, offsets)'''
+    offsets = np.zeros(len(components) + 1, dtype=np.int64)
+    np.cumsum([len(cc) for cc in components], out=offsets[1:])
+    if len(components):
+        fragments = np.concatenate(
+            [np.asarray(cc, dtype=np.uint64) for cc in components])
+    else:
+        fragments = np.zeros(0, dtype=np.uint64)
+    return fragments, offsets
+
+
+class LUTReader():
+    '''Reads the per-block arrays of one LUT directory, e.g.
+    ``edges_super2super`` or ``threshold_map_40``'''
+
+    def __init__(self, lut_dir):
+        self.lut_dir = lut_dir
+
+    def _load(self, block_id, name):
+        raise RuntimeError("To be implemented by derived class")
+
+    def _has(self, block_id, name):
+        '''Returns whether array `name` of the block is stored, for
+        layouts that store the precomputed indexes'''
+        return False
+
+    def block_ids(self):
+        '''Returns the sorted ids of all blocks in the LUT directory'''
+        raise RuntimeError("To be implemented by derived class")
+
+    def read_edges(self, block_id):
+        return self._load(block_id, 'edges')
+
+    def read_scored_edges(self, block_id):
+        return self._load(block_id, 'edges'), self._load(block_id, 'scores')
+
+    def read_components(self, block_id):
+        return (self._load(block_id, 'fragments'),
+                self._load(block_id, 'offsets'))
+
+    def _read_stored_adjacency(self, block_id, scored):
+        names = ADJACENCY_ARRAYS + (['scores'] if scored else [])
+        return AdjacencyIndex.from_arrays(
+            **{name: self._load(block_id, 'csr_' + name) for name in names})
+
+    def read_adjacency(self, block_id):
+        if self._has(block_id, 'csr_nodes'):
+            return self._read_stored_adjacency(block_id, scored=False)
+        return AdjacencyIndex(self.read_edges(block_id))
+
+    def read_scored_adjacency(self, block_id):
+        if self._has(block_id, 'csr_nodes'):
+            return self._read_stored_adjacency(block_id, scored=True)
+        return AdjacencyIndex(*self.read_scored_edges(block_id))
+
+    def read_component_index(self, block_id):
+        fragments, offsets = self.read_components(block_id)
+        if self._has(block_id, 'sorted_fragments'):
+            return ComponentIndex(
+                fragments, offsets,
+                sorted_fragments=self._load(block_id, 'sorted_fragments'),
+                sorted_labels=self._load(block_id, 'sorted_labels'))
+        return ComponentIndex(fragments, offsets)
+
+
+class NpzLUTReader(LUTReader):
+
+    def path(self, block_id):
+        return os.path.join(self.lut_dir, str(block_id) + '.npz')
+
+    def block_ids(self):
+        return list_block_ids(self.lut_dir)
+
+    def read_edges(self, block_id):
+        return np.load(self.path(block_id))['edges']
+
+    def read_scored_edges(self, block_id):
+        data = np.load(self.path(block_id))
+        return data['edges'], data['scores']
+
+    def read_components(self, block_id):
+        components = np.load(
+            self.path(block_id), allow_pickle=True)['threshold_map']
+        return flatten_components(components)
+
+
+class NpyLUTReader(LUTReader):
+
+    def __init__(self, lut_dir, mmap_mode='r'):
+        super().__init__(lut_dir)
+        self.mmap_mode = mmap_mode
+
+    def path(self, block_id, name):
+        return os.path.join(self.lut_dir, '%d.%s.npy' % (block_id, name))
+
+    def _load(self, block_id, name):
+        return np.load(self.path(block_id, name), mmap_mode=self.mmap_mode)
+
+    def _has(self, block_id, name):
+        return os.path.exists(self.path(block_id, name))
+
+    def block_ids(self):
+        block_ids = set()
+        for fname in os.listdir(self.lut_dir):
+            if fname.endswith('.npy'):
+                block_ids.add(int(fname.split('.')[0]))
+        return sorted(block_ids)
+
+
+def _array_from_npy_buffer(buf):
+    '''Zero-copy view of a serialized .npy array held in a uint8 buffer'''
+    major = int(buf[6])
+    if major == 1:
+        data_offset = 10 + int.from_bytes(buf[8:10].tobytes(), 'little')
+    else:
+        data_offset = 12 + int.from_bytes(buf[8:12].tobytes(), 'little')
+    header = io.BytesIO(buf[:data_offset].tobytes())
+    version = np.lib.format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+    count = int(np.prod(shape))
+    array = np.frombuffer(buf, dtype=dtype, count=count, offset=data_offset)
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+class ShardedLUTReader(LUTReader):
+
+    def __init__(self, lut_dir):
+        super().__init__(lut_dir)
+        self.shard_dir = os.path.join(lut_dir, 'shards')
+        index = np.load(os.path.join(self.shard_dir, 'index.npy'))
+        self.index = {}
+        for e in index:
+            self.index[(int(e['block_id']), e['name'].decode())] = (
+                int(e['shard']), int(e['offset']), int(e['length']))
+        self.shards = {}
+
+    def _get_shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(
+                os.path.join(self.shard_dir, 'shard_%04d.bin' % shard),
+                dtype=np.uint8, mode='r')
+        return self.shards[shard]
+
+    def _load(self, block_id, name):
+        entry = self.index.get((block_id, name))
+        if entry is None:
+            raise FileNotFoundError(
+                f'Block {block_id} ({name}) not found in {self.shard_dir}')
+        shard, offset, length = entry
+        return _array_from_npy_buffer(
+            self._get_shard(shard)[offset:offset+length])
+
+    def _has(self, block_id, name):
+        return (block_id, name) in self.index
+
+    def block_ids(self):
+        return sorted(set(block_id for block_id, _ in self.index))
+
+
+def open_lut_reader(lut_dir, lut_format='npz'):
+    if lut_format == 'npz':
+        return NpzLUTReader(lut_dir)
+    if lut_format == 'npy':
+        return NpyLUTReader(lut_dir)
+    if lut_format == 'sharded':
+        return ShardedLUTReader(lut_dir)
+    raise RuntimeError(
+        f'Unknown LUT format {lut_format}, expected one of {LUT_FORMATS}')
+
+
+def _save_npy(path, array):
+    # write to a temporary file first so that concurrent readers never map
+    # a partially written block
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def save_arrays(out_dir, arrays):
+    '''Saves a dict of arrays as ``<out_dir>/<name>.npy``'''
+    os.makedirs(out_dir, exist_ok=True)
+    for name, array in arrays.items():
+        _save_npy(os.path.join(out_dir, name + '.npy'), array)
+
+
+def load_arrays(in_dir, names, mmap_mode='r'):
+    '''Memory-maps arrays saved with `save_arrays`'''
+    return {
+        name: np.load(os.path.join(in_dir, name + '.npy'), mmap_mode=mmap_mode)
+        for name in names}
+
+
+def list_block_ids(lut_dir):
+    '''Returns the ids of all ``<block_id>.npz`` blocks in `lut_dir`'''
+    block_ids = []
+    for fname in os.listdir(lut_dir):
+        if fname.endswith('.npz'):
+            block_ids.append(int(fname[:-len('.npz')]))
+    return sorted(block_ids)
+
+
+def _read_npz_arrays(lut_dir, block_id):
+    '''Returns all arrays of one npz block, in their npy/sharded form,
+    plus the arrays of their lookup indexes'''
+    data = np.load(os.path.join(lut_dir, '%d.npz' % block_id), allow_pickle=True)
+    arrays = {}
+    if 'edges' in data:
+        arrays['edges'] = data['edges']
+        scores = None
+        if 'scores' in data:
+            arrays['scores'] = scores = data['scores']
+        for name, array in AdjacencyIndex(arrays['edges'], scores).arrays().items():
+            arrays['csr_' + name] = array
+    if 'threshold_map' in data:
+        fragments, offsets = flatten_components(data['threshold_map'])
+        arrays['fragments'] = fragments
+        arrays['offsets'] = offsets
+        index = ComponentIndex(fragments, offsets)
+        arrays['sorted_fragments'] = index.sorted_fragments
+        arrays['sorted_labels'] = index.sorted_labels
+    return arrays
+
+
+def convert_lut_dir_to_npy(lut_dir, overwrite=False):
+    '''Writes the npy layout next to every ``<block_id>.npz`` in `lut_dir`.
+    Returns the number of converted blocks.'''
+    reader = NpyLUTReader(lut_dir)
+    block_ids = list_block_ids(lut_dir)
+    for block_id in block_ids:
+        for name, array in _read_npz_arrays(lut_dir, block_id).items():
+            path = reader.path(block_id, name)
+            if overwrite or not os.path.exists(path):
+                _save_npy(path, array)
+    return len(block_ids)
+
+
+def convert_lut_dir_to_shards(lut_dir, num_shards=16):
+    '''Packs every ``<block_id>.npz`` in `lut_dir` into `num_shards` shard
+    files under ``<lut_dir>/shards``. Returns the number of packed blocks.'''
+    shard_dir = os.path.join(lut_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    block_ids = list_block_ids(lut_dir)
+    num_shards = max(1, min(num_shards, len(block_ids)))
+
+    index = []
+    # contiguous ranges of block ids go into the same shard
+    for shard, shard_block_ids in enumerate(np.array_split(block_ids, num_shards)):
+        path = os.path.join(shard_dir, 'shard_%04d.bin' % shard)
+        with open(path + '.tmp', 'wb') as f:
+            for block_id in shard_block_ids.tolist():
+                for name, array in _read_npz_arrays(lut_dir, block_id).items():
+                    buf = io.BytesIO()
+                    np.save(buf, np.ascontiguousarray(array))
+                    index.append((block_id, name, shard, f.tell(), buf.tell()))
+                    f.write(buf.getbuffer())
+        os.replace(path + '.tmp', path)
+
+    # the index is written last so that readers never see a partial LUT
+    _save_npy(os.path.join(shard_dir, 'index.npy'),
+              np.array(index, dtype=SHARD_INDEX_DTYPE))
+    return len(block_ids)
+
+
+def convert_super_lut(super_lut_dir, lut_format='npy', **kwargs):
+    '''Converts ``edges_super2super`` and all ``threshold_map_XX``
+    directories of one ``super_..._XX`` LUT directory to `lut_format`'''
+    if lut_format == 'npy':
+        convert = convert_lut_dir_to_npy
+    elif lut_format == 'sharded':
+        convert = convert_lut_dir_to_shards
+    else:
+        raise RuntimeError(f'Cannot convert to LUT format {lut_format}')
+    for d in sorted(os.listdir(super_lut_dir)):
+        if (d in ['edges_super2super', SCORED_EDGES_DIR]
+                or d.startswith('threshold_map_')):
+            n = convert(os.path.join(super_lut_dir, d), **kwargs)
+            print(f'Converted {n} blocks in {d}')
+
+
+def find_edge_thresholds(super_lut_pre):
+    '''Returns the sorted thresholds that ``<super_lut_pre>_XX`` directories
+    with an ``edges_super2super`` LUT exist for'''
+    thresholds = []
+    for d in glob.glob(super_lut_pre + '_*'):
+        suffix = d[len(super_lut_pre) + 1:]
+        if suffix.isdigit() and os.path.isdir(os.path.join(d, 'edges_super2super')):
+            thresholds.append(int(suffix) / 100)
+    return sorted(thresholds)
+
+
+def _score_block_edges(edge_lists, thresholds):
+    '''Merges the edge lists of one block at increasing `thresholds` into
+    unique (edges, scores), scoring each edge with the first threshold it
+    appears at'''
+    edges = [np.zeros((0, 2), dtype=np.uint64)]
+    scores = [np.zeros(0, dtype=np.float32)]
+    for block_edges, threshold in zip(edge_lists, thresholds):
+        block_edges = np.asarray(block_edges, dtype=np.uint64).reshape(-1, 2)
+        # edges are undirected
+        edges.append(np.sort(block_edges, axis=1))
+        scores.append(np.full(len(block_edges), threshold, dtype=np.float32))
+    edges = np.concatenate(edges)
+    scores = np.concatenate(scores)
+    # np.unique returns the first occurrence, i.e. the lowest threshold
+    edges, first = np.unique(edges, axis=0, return_index=True)
+    return edges.reshape(-1, 2), scores[first]
+
+
+def build_scored_edges(super_lut_pre, base_threshold, thresholds=None):
+    '''Writes the edges of the ``<super_lut_pre>_XX/edges_super2super`` LUTs
+    of all `thresholds` (default: all that exist) once, with their merge
+    scores, to ``<super_lut_pre>_<base>/edges_super2super_scored``.
+    Returns the number of written blocks.'''
+    if thresholds is None:
+        thresholds = find_edge_thresholds(super_lut_pre)
+    thresholds = sorted(thresholds)
+    readers = [
+        NpzLUTReader(os.path.join(
+            super_lut_pre + '_%d' % int(t*100), 'edges_super2super'))
+        for t in thresholds]
+    out_dir = os.path.join(
+        super_lut_pre + '_%d' % int(base_threshold*100), SCORED_EDGES_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+
+    block_ids = sorted(set(
+        block_id for reader in readers for block_id in reader.block_ids()))
+    for block_id in block_ids:
+        edge_lists = []
+        block_thresholds = []
+        for reader, threshold in zip(readers, thresholds):
+            if os.path.exists(reader.path(block_id)):
+                edge_lists.append(reader.read_edges(block_id))
+                block_thresholds.append(threshold)
+        edges, scores = _score_block_edges(edge_lists, block_thresholds)
+        path = os.path.join(out_dir, '%d.npz' % block_id)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, edges=edges, scores=scores)
+        os.replace(path + '.tmp', path)
+    return len(block_ids)
+
+
+if __name__ == "__main__":
+
+    if sys.argv[1] == 'scored':
+        # python -m segway.mdseg.lut_io scored <super_lut_pre> <base_threshold>
+        n = build_scored_edges(sys.argv[2], float(sys.argv[3]))
+        print(f'Scored the edges of {n} blocks')
+    else:
+        lut_format = sys.argv[1]
+        for super_lut_dir in sys.argv[2:]:
+            convert_super_lut(super_lut_dir, lut_format)
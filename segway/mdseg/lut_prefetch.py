@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LUTPrefetcher():
+    '''Loads LUT blocks into a `LUTCache` on a bounded background thread pool.
+
+    Prefetching never competes with foreground requests: `cancel()` drops
+    all queued loads (the server calls it when a new query arrives), at most
+    `max_pending` loads are queued, and blocks are only loaded while the
+    cache holds less than `max_bytes` and only inserted if they fit without
+    evicting anything.
+    '''
+
+    def __init__(self, lut_cache, num_workers=2, max_pending=64, max_bytes=None):
+        self.lut_cache = lut_cache
+        self.max_pending = max_pending
+        if max_bytes is None:
+            max_bytes = lut_cache.cache_bytes // 2
+        self.max_bytes = max_bytes
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix='lut_prefetch')
+        self.pending = {}
+        self.lock = Lock()
+
+    def prefetch(self, key, load_fn, *args):
+        with self.lock:
+            if key in self.pending or len(self.pending) >= self.max_pending:
+                return
+            if key in self.lut_cache:
+                return
+            if self.lut_cache.currsize >= self.max_bytes:
+                return
+            self.pending[key] = self.executor.submit(
+                self._load, key, load_fn, *args)
+
+    def _load(self, key, load_fn, *args):
+        try:
+            if (key not in self.lut_cache
+                    and self.lut_cache.currsize < self.max_bytes):
+                self.lut_cache.put(key, load_fn(*args), evict=False)
+        except Exception as e:
+            # blocks outside of the volume simply do not exist
+            logger.debug("Prefetching %s failed: %s" % (key, e))
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def cancel(self):
+        '''Cancels all prefetches that have not started yet'''
+        with self.lock:
+            for key, future in list(self.pending.items()):
+                if future.cancel():
+                    del self.pending[key]
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=True)
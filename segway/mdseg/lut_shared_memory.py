@@ -0,0 +1,266 @@
+'''Shares decoded LUT blocks between the segment server processes of a host.
+
+`SharedLUTRegistry` keeps each block's arrays in one
+`multiprocessing.shared_memory` segment and records the segments in a SQLite
+file that all processes open. A process that needs a block attaches to the
+existing segment (zero-copy) instead of reading and decoding the LUT file
+again.
+
+Each attaching process is recorded per block (reference counting by pid, so
+that crashed processes do not pin blocks forever). The registry keeps the
+total size of all segments under `budget_bytes` by unlinking the least
+recently used blocks that no process is attached to. On Linux, a segment
+unlinked while still mapped stays valid until its last mapping is closed.
+
+Segments are not registered with multiprocessing's resource tracker, which
+would otherwise unlink them when the process that created them exits. A
+released segment is only unmapped once no array viewing it is left in the
+process.
+'''
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from threading import Lock
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# array offsets within a segment are aligned for any dtype
+ALIGNMENT = 64
+
+
+def _open_shared_memory(name, create=False, size=0):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(
+            name=name, create=create, size=size, track=False)
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _unlink_shared_memory(name):
+    try:
+        shm = _open_shared_memory(name)
+    except FileNotFoundError:
+        return
+    if sys.version_info < (3, 13):
+        # unlink() unregisters the segment from the resource tracker again
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.close()
+    shm.unlink()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _layout(arrays):
+    '''Returns ([(name, dtype, shape, offset)], total size) for packing
+    `arrays` into one buffer'''
+    layout = []
+    offset = 0
+    for name, array in arrays.items():
+        layout.append((name, array.dtype.str, list(array.shape), offset))
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    return layout, offset
+
+
+class SharedLUTRegistry():
+    '''Registry of LUT blocks in shared memory, see the module docstring.
+
+    `get(key)` and `put(key, arrays)` return {name: read-only array} views
+    into the block's segment and attach the calling process to it; every
+    successful `get`/`put` is to be paired with a `release(key)`.
+    '''
+
+    def __init__(self, registry_file, budget_bytes=8*1024*1024*1024, prefix='mdseg'):
+        self.registry_file = registry_file
+        self.budget_bytes = budget_bytes
+        self.prefix = prefix
+        self.pid = os.getpid()
+        self.lock = Lock()
+        self.con = sqlite3.connect(
+            registry_file, timeout=60, isolation_level=None, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, shm_name TEXT, nbytes INTEGER, '
+            'layout TEXT, last_used REAL)')
+        self.con.execute(
+            'CREATE TABLE IF NOT EXISTS attachments ('
+            'key TEXT, pid INTEGER, PRIMARY KEY (key, pid))')
+        # key -> [segment, number of local users, uint8 array of the segment]
+        self.attached = {}
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def _transaction(self):
+        # takes the write lock up front so that processes do not deadlock
+        # upgrading a read lock
+        self.con.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.con.execute('ROLLBACK')
+            raise
+        else:
+            self.con.execute('COMMIT')
+
+    def _views(self, key, layout):
+        # all views are derived from one array, which numpy keeps alive as
+        # their base, so that its finalizer tells when the segment can be
+        # unmapped (numpy does not hold a buffer export on the segment)
+        data = self.attached[key][2]
+        views = {}
+        for name, dtype, shape, offset in layout:
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            views[name] = data[offset:offset+nbytes].view(dtype).reshape(shape)
+        return views
+
+    def _open(self, key, shm):
+        data = np.ndarray((shm.size,), dtype=np.uint8, buffer=shm.buf)
+        data.flags.writeable = False
+        self.attached[key] = [shm, 1, data]
+
+    def _attach(self, key, shm_name):
+        '''Opens the segment of `key` locally; the caller holds the
+        transaction that records the attachment'''
+        if key in self.attached:
+            self.attached[key][1] += 1
+            return
+        self._open(key, _open_shared_memory(shm_name))
+        self.con.execute(
+            'INSERT OR IGNORE INTO attachments VALUES (?, ?)', (key, self.pid))
+
+    def get(self, key):
+        '''Returns the arrays of `key`, or None if the block is not shared'''
+        with self.lock:
+            with self._transaction():
+                row = self.con.execute(
+                    'SELECT shm_name, layout FROM entries WHERE key=?',
+                    (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self._attach(key, row[0])
+                self.con.execute(
+                    'UPDATE entries SET last_used=? WHERE key=?', (time.time(), key))
+            self.hits += 1
+            return self._views(key, json.loads(row[1]))
+
+    def _evict(self, nbytes):
+        '''Unlinks unattached blocks, least recently used first, until
+        `nbytes` more fit into the budget. Returns whether they fit.'''
+        pids = [pid for (pid,) in self.con.execute(
+            'SELECT DISTINCT pid FROM attachments')]
+        for pid in pids:
+            if pid != self.pid and not _pid_alive(pid):
+                self.con.execute('DELETE FROM attachments WHERE pid=?', (pid,))
+
+        used = self.con.execute(
+            'SELECT COALESCE(SUM(nbytes), 0) FROM entries').fetchone()[0]
+        if used + nbytes <= self.budget_bytes:
+            return True
+        candidates = self.con.execute(
+            'SELECT key, shm_name, nbytes FROM entries WHERE key NOT IN '
+            '(SELECT key FROM attachments) ORDER BY last_used').fetchall()
+        for key, shm_name, entry_nbytes in candidates:
+            _unlink_shared_memory(shm_name)
+            self.con.execute('DELETE FROM entries WHERE key=?', (key,))
+            used -= entry_nbytes
+            if used + nbytes <= self.budget_bytes:
+                return True
+        return False
+
+    def put(self, key, arrays):
+        '''Copies `arrays` into a new segment for `key` (or attaches to the
+        segment another process created meanwhile) and returns the shared
+        views, or None if the block does not fit into the budget'''
+        arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+        layout, nbytes = _layout(arrays)
+        with self.lock:
+            with self._transaction():
+                row = self.con.execute(
+                    'SELECT shm_name, layout FROM entries WHERE key=?',
+                    (key,)).fetchone()
+                if row is not None:
+                    self._attach(key, row[0])
+                    return self._views(key, json.loads(row[1]))
+
+                if not self._evict(nbytes):
+                    return None
+                shm_name = '%s_%s' % (self.prefix, uuid.uuid4().hex[:16])
+                shm = _open_shared_memory(shm_name, create=True, size=max(nbytes, 1))
+                for (name, _, _, offset), array in zip(layout, arrays.values()):
+                    shm.buf[offset:offset+array.nbytes] = array.reshape(-1).view(np.uint8)
+                self.con.execute(
+                    'INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                    (key, shm_name, nbytes, json.dumps(layout), time.time()))
+                self._open(key, shm)
+                self.con.execute(
+                    'INSERT OR IGNORE INTO attachments VALUES (?, ?)', (key, self.pid))
+                return self._views(key, layout)
+
+    @staticmethod
+    def _close_when_unused(entry):
+        shm, _, data = entry
+        weakref.finalize(data, shm.close)
+
+    def release(self, key):
+        '''Detaches this process from `key` once all its users released it'''
+        with self.lock:
+            entry = self.attached.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self.attached[key]
+            self.con.execute(
+                'DELETE FROM attachments WHERE key=? AND pid=?', (key, self.pid))
+            self._close_when_unused(entry)
+
+    def stats(self):
+        with self.lock:
+            entries, nbytes = self.con.execute(
+                'SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM entries').fetchone()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': entries,
+                'bytes': nbytes,
+                'budget_bytes': self.budget_bytes,
+                'attached': len(self.attached),
+            }
+
+    def close(self):
+        '''Detaches this process from all blocks'''
+        with self.lock:
+            self.con.execute(
+                'DELETE FROM attachments WHERE pid=?', (self.pid,))
+            for entry in self.attached.values():
+                self._close_when_unused(entry)
+            self.attached = {}
+            self.con.close()
+
+    def unlink_all(self):
+        '''Removes all blocks that no process is attached to'''
+        with self.lock:
+            with self._transaction():
+                self._evict(self.budget_bytes + 1)
@@ -0,0 +1,249 @@
+'''Runs one `ConnectedSegmentServer` in its own process and serves it to many
+viewers over HTTP (TCP or a Unix socket), so that all annotators on a node
+share one LUT cache.
+
+    python -m segway.mdseg.segment_server_http config.json --port 8765
+
+where ``config.json`` holds the keyword arguments of ConnectedSegmentServer.
+Viewers then use a `ConnectedSegmentClient` in place of the server:
+
+    prserver = ConnectedSegmentClient('http://localhost:8765')
+    MDSegViewer(prserver, neuron_db)
+
+Endpoints (JSON bodies):
+
+    POST /find_connected_super_fragments  the arguments of the method
+                                          -> {"connected": [...]}
+    POST /find_connected_many             {"requests": [arguments, ...]}
+                                          -> {"connected": [[...], ...]}
+    GET  /stats                           cache and timing statistics
+'''
+import argparse
+import http.client
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from .connected_segment_server import ConnectedSegmentServer
+
+logger = logging.getLogger(__name__)
+
+# keyword arguments of find_connected_super_fragments accepted over HTTP
+GROW_ARGUMENTS = [
+    'selected_super_fragments',
+    'no_grow_super_fragments',
+    'threshold',
+    'z_only',
+    'grow_to_closure',
+    'max_closure_nodes',
+    'max_closure_time',
+    'locked_axes',
+]
+
+
+class SegmentServerHTTPHandler(BaseHTTPRequestHandler):
+    '''Handles requests for the `ConnectedSegmentServer` given as the
+    `segment_server` attribute of the HTTP server'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _grow(self, request):
+        unknown = set(request) - set(GROW_ARGUMENTS)
+        if unknown:
+            raise ValueError(f'Unknown arguments {sorted(unknown)}')
+        return [int(n) for n in
+                self.server.segment_server.find_connected_super_fragments(**request)]
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        segment_server = self.server.segment_server
+        self._send_json(200, {
+            'cache': segment_server.cache_stats(),
+            'instrumentation': segment_server.instrumentation.stats(),
+        })
+
+    def do_POST(self):
+        try:
+            request = self._read_json()
+            if self.path == '/find_connected_super_fragments':
+                response = {'connected': self._grow(request)}
+            elif self.path == '/find_connected_many':
+                response = {'connected': [
+                    self._grow(r) for r in request['requests']]}
+            else:
+                self._send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': repr(e)})
+            return
+        except Exception as e:
+            logger.exception("Request to %s failed" % self.path)
+            self._send_json(500, {'error': repr(e)})
+            return
+        self._send_json(200, response)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+def make_http_server(segment_server, host='127.0.0.1', port=8765, unix_socket=None):
+    '''Returns an HTTP server for `segment_server` that handles every
+    connection in its own thread; call `serve_forever()` on it'''
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        http_server = ThreadingUnixHTTPServer(unix_socket, SegmentServerHTTPHandler)
+    else:
+        http_server = ThreadingHTTPServer((host, port), SegmentServerHTTPHandler)
+    http_server.segment_server = segment_server
+    return http_server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, unix_socket, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+class ConnectedSegmentClient():
+    '''Drop-in replacement of `ConnectedSegmentServer` for `MDSegViewer`
+    that forwards grows to a server started with this module.
+
+    `url` is ``http://host:port`` or ``unix:///path/to/socket``.
+    '''
+
+    def __init__(self, url='http://127.0.0.1:8765', timeout=60):
+        self.url = url
+        self.timeout = timeout
+        # http.client connections must not be shared between threads
+        self.local = threading.local()
+
+    def _connect(self):
+        parsed = urlparse(self.url)
+        if parsed.scheme == 'unix':
+            return _UnixHTTPConnection(parsed.path, timeout=self.timeout)
+        return http.client.HTTPConnection(
+            parsed.hostname, parsed.port, timeout=self.timeout)
+
+    def _request(self, method, path, data=None):
+        body = None if data is None else json.dumps(data).encode()
+        headers = {'Content-Type': 'application/json'}
+        for retry in (True, False):
+            connection = getattr(self.local, 'connection', None)
+            if connection is None:
+                connection = self.local.connection = self._connect()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                result = json.loads(response.read())
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed the kept-alive connection, reconnect once
+                connection.close()
+                self.local.connection = None
+                if not retry:
+                    raise
+        if response.status != 200:
+            raise RuntimeError(
+                f'Segment server error {response.status}: {result.get("error")}')
+        return result
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def find_connected_super_fragments(
+            self,
+            selected_super_fragments,
+            no_grow_super_fragments,
+            threshold,
+            z_only=False,
+            **kwargs,
+            ):
+        request = dict(
+            selected_super_fragments=[int(n) for n in selected_super_fragments],
+            no_grow_super_fragments=[int(n) for n in no_grow_super_fragments],
+            threshold=threshold,
+            z_only=z_only,
+            **kwargs)
+        return self._request(
+            'POST', '/find_connected_super_fragments', request)['connected']
+
+    def find_connected_many(self, requests):
+        '''Runs several grows in one round trip. Each request is a dict of
+        `find_connected_super_fragments` arguments.'''
+        requests = [dict(r) for r in requests]
+        for r in requests:
+            for key in ['selected_super_fragments', 'no_grow_super_fragments']:
+                r[key] = [int(n) for n in r.get(key, [])]
+        return self._request(
+            'POST', '/find_connected_many', {'requests': requests})['connected']
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='python -m segway.mdseg.segment_server_http')
+    parser.add_argument('config', help="JSON file with the ConnectedSegmentServer arguments")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.config) as f:
+        config = json.load(f)
+
+    segment_server = ConnectedSegmentServer(**config)
+    http_server = make_http_server(
+        segment_server, host=args.host, port=args.port, unix_socket=args.unix_socket)
+    logger.info("Serving %s on %s" % (
+        args.config, args.unix_socket or '%s:%d' % (args.host, args.port)))
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        segment_server.close()
@@ -163,11 +163,13 @@ class MDSegViewer():
         viewer.actions.add('grow-segments-super', lambda s: self.grow_segments(s, super_threshold=True))
         viewer.actions.add('grow-segments-diff', lambda s: self.grow_segments(s, super_threshold=True, diff_grow=True))
         viewer.actions.add('grow-segments-z', lambda s: self.grow_segments(s, z_only=True))
+        viewer.actions.add('grow-segments-closure', lambda s: self.grow_segments(s, to_closure=True))
         with viewer.config_state.txn() as s:
             s.input_event_bindings.viewer['keyq'] = 'grow-segments'
             s.input_event_bindings.viewer['shift+keyq'] = 'grow-segments-super'
             s.input_event_bindings.viewer['keyw'] = 'grow-segments-diff'
             s.input_event_bindings.viewer['control+keyq'] = 'grow-segments-z'
+            s.input_event_bindings.viewer['alt+keyq'] = 'grow-segments-closure'
 
         self.clipboard_sel = []
         viewer.actions.add('copy-selections', lambda s: self.copy_selections(s))
@@ -512,7 +514,7 @@ class MDSegViewer():
                     filtered_blacklist.append(b)
         return filtered_blacklist
 
-    def grow_segments(self, s, z_only=False, super_threshold=False, diff_grow=False):
+    def grow_segments(self, s, z_only=False, super_threshold=False, diff_grow=False, to_closure=False):
 
         selected = MDSegViewer._get_viewer_segments(s)
         threshold1 = float(self._get_non_wrapped_property(
@@ -521,11 +523,15 @@ class MDSegViewer():
             'pr', 'prSuperGrowThreshold', default=0.5))
 
         if not diff_grow:
+            grow_kwargs = {}
+            if to_closure:
+                grow_kwargs['grow_to_closure'] = True
             cc = self.prserver.find_connected_super_fragments(
                 selected_super_fragments=selected,
                 no_grow_super_fragments=self.blacklist_segments,
                 threshold=threshold1,
                 z_only=z_only,
+                **grow_kwargs,
                 )
 
         grow_count = len(cc) - len(selected)
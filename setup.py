@@ -10,6 +10,7 @@ setup(
         packages=[
             'segway.mdseg',
             'segway.mdseg.database',
+            'segway.mdseg.benchmark',
         ],
         install_requires=[
             "funlib.math",
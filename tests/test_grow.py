@@ -0,0 +1,134 @@
+'''Checks the vectorized grow of `ConnectedSegmentServer` against a
+straightforward per-fragment reference on a `SyntheticLUT`.'''
+import contextlib
+import io
+import random
+
+import numpy as np
+import pytest
+
+from funlib.math import cantor_number, inv_cantor_number
+
+from segway.mdseg.benchmark import SyntheticLUT
+from segway.mdseg.cantor import cantor_numbers, inv_cantor_numbers
+from segway.mdseg.connected_segment_server import ConnectedSegmentServer
+from segway.mdseg.lut_io import convert_super_lut
+
+
+def test_cantor_numbers():
+    rng = np.random.default_rng(0)
+    indices = np.concatenate([
+        np.array(list(np.ndindex(6, 6, 6))),
+        rng.integers(0, 50000, size=(1000, 3))])
+    numbers = cantor_numbers(indices)
+    for index, number in zip(indices.tolist(), numbers.tolist()):
+        assert number == int(cantor_number(index))
+    assert inv_cantor_numbers(numbers).tolist() == indices.tolist()
+    for number in numbers[:300].tolist():
+        assert inv_cantor_numbers([number])[0].tolist() == \
+            [int(i) for i in inv_cantor_number(number)]
+
+
+class ReferenceGrow():
+    '''The grow of the original server, one fragment and one edge at a time,
+    on the in-memory graph of a `SyntheticLUT`'''
+
+    def __init__(self, lut):
+        self.lut = lut
+        self.index = {int(f): i for i, f in enumerate(lut.fragments)}
+        self.neighbors_at = {}
+
+    def neighbors(self, threshold):
+        if threshold not in self.neighbors_at:
+            neighbors = {}
+            for u, v in self.lut.edges_at(threshold).tolist():
+                neighbors.setdefault(u, set()).add(v)
+                neighbors.setdefault(v, set()).add(u)
+            self.neighbors_at[threshold] = neighbors
+        return self.neighbors_at[threshold]
+
+    def component(self, fragment, neighbors):
+        component = {fragment}
+        stack = [fragment]
+        while stack:
+            for v in neighbors.get(stack.pop(), ()):
+                if v not in component:
+                    component.add(v)
+                    stack.append(v)
+        return component
+
+    def base_subsegment(self, fragment, threshold):
+        # the component at `threshold` restricted to the fragment's super
+        # block, as stored in its threshold map
+        super_ids = self.lut.fragment_super_id
+        component = [
+            f for f in self.component(fragment, self.neighbors(threshold))
+            if super_ids[f] == super_ids[fragment]]
+        if len(component) < 2:
+            return set()
+        return set(component)
+
+    def grow(self, selected, no_grow, threshold, z_only=False):
+        lut = self.lut
+        neighbors = self.neighbors(lut.base_threshold)
+        no_grow = set(self.index[f] for f in no_grow)
+        connected = set()
+        for f in selected:
+            f = self.index[f]
+            connected.add(f)
+            if f in no_grow:
+                continue
+            for v in neighbors.get(f, ()):
+                if z_only and (lut.fragment_super_index[v][1:] !=
+                               lut.fragment_super_index[f][1:]).any():
+                    continue
+                if v not in no_grow:
+                    connected.add(v)
+
+        if threshold != lut.base_threshold:
+            for f in list(connected):
+                component = self.base_subsegment(f, threshold)
+                if component.isdisjoint(no_grow):
+                    connected |= component
+        return set(int(lut.fragments[f]) for f in connected)
+
+
+@pytest.fixture(scope='module')
+def synthetic_lut(tmp_path_factory):
+    lut = SyntheticLUT(grid_shape=(2, 2, 2), fragments_per_block=4, seed=1)
+    out_dir = str(tmp_path_factory.mktemp('lut'))
+    lut.write(out_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for threshold in lut.thresholds:
+            for lut_format in ['npy', 'sharded']:
+                convert_super_lut(lut.lut_dir(out_dir, threshold), lut_format)
+    server = ConnectedSegmentServer(**lut.server_kwargs(out_dir))
+    for threshold in lut.thresholds:
+        server.build_global_labels(threshold)
+    server.close()
+    return lut, out_dir
+
+
+@pytest.mark.parametrize('lut_format', ['npz', 'npy', 'sharded'])
+@pytest.mark.parametrize('global_labels', [False, True])
+def test_find_connected_super_fragments(synthetic_lut, lut_format, global_labels):
+    lut, out_dir = synthetic_lut
+    reference = ReferenceGrow(lut)
+    server = ConnectedSegmentServer(
+        **lut.server_kwargs(out_dir),
+        lut_format=lut_format,
+        global_labels=global_labels)
+    fragments = [int(f) for f in lut.fragments]
+    rng = random.Random(0)
+    try:
+        for _ in range(30):
+            selected = rng.sample(fragments, rng.choice([1, 5, 40]))
+            no_grow = rng.sample(fragments, rng.choice([0, 20, 200]))
+            threshold = rng.choice(lut.thresholds)
+            z_only = rng.choice([False, True])
+            grown = server.find_connected_super_fragments(
+                selected, no_grow, threshold, z_only=z_only)
+            assert sorted(grown) == sorted(
+                reference.grow(selected, no_grow, threshold, z_only))
+    finally:
+        server.close()